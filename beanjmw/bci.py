@@ -3,6 +3,10 @@
 #
 import sys
 import argparse
+import logging
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from os import path
 import os, re
 sys.path.insert(0, path.abspath(os.curdir))
@@ -14,9 +18,14 @@ from beancount.ingest import scripts_utils
 from beancount.ingest import extract
 from beancount.ingest import cache
 from beancount.ingest.identify import find_imports
+from beancount.ingest import identify
+from beancount.ingest import file as ingest_file
+from beancount import loader
 
-from importers.filters.assign import assign_accounts, assign_check_payees
-from importers.filters.assign import deduplicate, auto_open
+from importers.filters.assign import assign_accounts_iter, assign_check_payees
+from importers.filters.assign import new_opens_first, deduplicate_iter, auto_open_iter
+from beanjmw.importers.filters.dedup import get_ledger_index
+from beanjmw.importers import ingest_cache
 
 import importers.filters.assign 
 importers.filters.assign.dir_path=path.join(path.abspath(os.curdir),"yaml")
@@ -31,6 +40,18 @@ remove_duplicates=True
 # only import this matching account
 # See argv kludge at bottom of file
 account_filter=None
+# use the saved fingerprint index of the existing ledger (-e) instead of
+# loading all of its entries (not with assign.multi_posting_dedup, which 
+# needs all postings)
+use_ledger_index=True
+# set from the -e ledger if use_ledger_index is True
+ledger_index=None
+# report Bloom filter hit/miss rates of the ledger index on stderr
+dedup_stats=True
+# number of processes extracting downloads (extract --jobs N)
+extract_jobs=1
+# downloads given to ingest with -d (the current directory if None)
+ingest_downloads=None
 
 try:
     import accts
@@ -39,23 +60,43 @@ except ModuleNotFoundError as mnf:
     import example_accts as accts
 
 CONFIG = accts.CONFIG
+# optional, set False to parse every download on every run 
+if hasattr(accts, "extract_cache"):
+    ingest_cache.use_extract_cache=accts.extract_cache
+# optional directory of the extract cache (not under the downloads)
+if hasattr(accts, "extract_cache_dir"):
+    ingest_cache.cache_dir=accts.extract_cache_dir
+# optional number of processes extracting downloads
+if hasattr(accts, "extract_jobs"):
+    extract_jobs=accts.extract_jobs
+# extracted entries of unchanged downloads come from the extract cache
+CONFIG = ingest_cache.cached_config(CONFIG)
+# optional number of processes for account assignment
+if hasattr(accts, "assign_workers"):
+    importers.filters.assign.assign_workers=accts.assign_workers
+# optional per-rule hit counts and times in yaml/<account>_profile.tsv
+if hasattr(accts, "profile_rules"):
+    importers.filters.assign.profile_rules=accts.profile_rules
 
 # Override the header on extracted text (if desired).
 extract.HEADER = ';; -*- mode: org; mode: beancount; coding: utf-8; -*-\n'
 extract.HEADER = ''
 
-def filter_entries(extracted_entries_list):
+def filter_entries(extracted_entries_list, downloads=None):
     # This ugly little thing is used to reconstruct accounts associated with 
     # the files in the extracted_entries_list	
 	# NOTE: This depends on the extracted_entries_list being in the same 
-	# order as find_imports (lexical sort) 
+	# order as find_imports (lexical sort) of the same downloads (files or
+	# directories, the current directory if None)
     accounts = [] # same length as filtered_entries_list
     # filtered_entries_list has only the account_filter matches
     filtered_entries_list=[]
 
 	# NOTE: This is how ingest/scripts_utils finds the file list
     # we will filter here for specific account if specified
-    extracted_filenames=[path.abspath(os.curdir)]
+    extracted_filenames=downloads or ingest_downloads
+    if extracted_filenames==None:
+        extracted_filenames=[path.abspath(os.curdir)]
     entryno=0
     for filename, importers in find_imports(CONFIG, extracted_filenames,logfile=None):
         file = cache.get_file(filename)
@@ -73,7 +114,7 @@ def filter_entries(extracted_entries_list):
             filtered_entries_list.append((filename,entries))
     return filtered_entries_list,accounts
 
-def process_extracted_entries(extracted_entries_list, ledger_entries):
+def process_extracted_entries(extracted_entries_list, ledger_entries, downloads=None):
     """ Filter function
 
     Args:
@@ -82,6 +123,8 @@ def process_extracted_entries(extracted_entries_list, ledger_entries):
       ledger_entries: If provided, a list of directives from the existing
         ledger of the user. This is non-None if the user provided their
         ledger file as an option.
+      downloads: files or directories the entries were extracted from,
+        None for the ingest downloads (see ingest_downloads)
 	
 		Use the command line argument 'existing' ('-e') to include
 		 ledger_entries
@@ -91,47 +134,319 @@ def process_extracted_entries(extracted_entries_list, ledger_entries):
       (filename, entries), to be printed.
     """
 
-    filtered_entries_list, accounts = filter_entries(extracted_entries_list)
+    if ledger_entries==None and ledger_index!=None:
+        ledger_entries=ledger_index
+
+    filtered_entries_list, accounts = filter_entries(extracted_entries_list, downloads)
     if len(filtered_entries_list)==0:
         return([("Nothing to do",[])])
     
     # Now we can get the check and account assignment yaml files
 	# Assign payees to check via <account>_payees.yaml file for account
-    new_entries_list=[]
-    new_accounts=[]
-    for (fn,entries),(f,acct) in zip(filtered_entries_list,accounts):
-        if "CHECKING" in acct.upper():
-            new_entries_list.append((fn,assign_check_payees(entries,acct,fn)))
-            new_accounts.append((fn,acct))
-        else:
-            new_entries_list.append((fn,entries))
-            new_accounts.append((fn,acct))
+    # (check payees and accounts are assigned one file at a time)
+    new_entries_list=check_payees_iter(filtered_entries_list,accounts)
 
     # assign new accounts, and possibly open them
 	# unassigned accounts will be sent to <account>_unassigned.yaml
-    new_entries_list=assign_accounts(new_entries_list,ledger_entries,new_accounts)
+    new_entries_list=assign_accounts_iter(zip(new_entries_list,accounts),ledger_entries)
 
     # for each extracted entry, look for duplicates
-    deduped_entries_list=deduplicate(new_entries_list, ledger_entries)	
+    # new opens go first, and each file is compared to the files after it,
+    # so this waits for the last file
+    deduped_entries_list=deduplicate_iter(new_opens_first(new_entries_list), ledger_entries)
 
 	# remove open statements and use the auto plugin if true
 	# that gets rid of "duplicate open" errors in bean-check
 	# for accounts kept in separate files
     if hasattr(accts, "auto_open"):
         if accts.auto_open:
-            deduped_entries_list = auto_open(deduped_entries_list)
+            deduped_entries_list = auto_open_iter(deduped_entries_list)
 
+    # ingest needs a list
+    deduped_entries_list=list(deduped_entries_list)
+    if dedup_stats and ledger_index!=None and ledger_index.bloom!=None:
+        sys.stderr.write("Dedup prefilter: {0}\n".format(ledger_index.bloom_stats()))
     return deduped_entries_list
 
+def check_payees_iter(filtered_entries_list, accounts):
+    """ Assigns check payees for checking accounts, one file at a time
+
+    Returns:
+      generator of (filename, entries) pairs
+    """
+    for (fn,entries),(f,acct) in zip(filtered_entries_list,accounts):
+        if "CHECKING" in acct.upper():
+            entries=assign_check_payees(entries,acct,fn)
+        yield (fn,entries)
+
+def identify_downloads(downloads=None):
+    """ Same as bci identify
+
+    Returns:
+      A list of (filename, importer name, account) for each importer that
+      matches a download
+    """
+    if downloads==None:
+        downloads=[path.abspath(os.curdir)]
+    identified=[]
+    for filename, importers in find_imports(CONFIG, downloads):
+        file = cache.get_file(filename)
+        for importer in importers:
+            identified.append((filename, importer.name(), importer.file_account(file)))
+    return identified
+
+def archive_jobs(destination, downloads, mkdirs=True, overwrite=True):
+    """ Destinations of the downloads, with the checks of bci file
+
+    Returns:
+      (list of (filename, destination filename), True if any destination
+      is missing, exists or collides with another; the errors are logged)
+    """
+    jobs=[]
+    has_errors=False
+    for filename, importers in find_imports(CONFIG, downloads):
+        if not importers:
+            continue
+        new_fullname=ingest_file.file_one_file(filename, importers, destination, idify=True)
+        if new_fullname==None:
+            continue
+        new_dirname=path.dirname(new_fullname)
+        if not path.exists(new_dirname) and not mkdirs:
+            logging.error("Destination directory '{}' does not exist.".format(new_dirname))
+            has_errors=True
+            continue
+        if not overwrite and path.exists(new_fullname):
+            logging.error("Destination file '{}' already exists.".format(new_fullname))
+            has_errors=True
+            continue
+        jobs.append((filename, new_fullname))
+    sources=OrderedDict()
+    for src, dest in jobs:
+        sources.setdefault(dest, []).append(src)
+    for dest, srcs in sources.items():
+        if len(srcs)!=1:
+            logging.error("Collision in destination filenames '{}': from {}.".format(
+                dest, ", ".join(["'{}'".format(src) for src in srcs])))
+            has_errors=True
+    return jobs, has_errors
+
+def archive_downloads(destination, dry_run=False, downloads=None, overwrite=True):
+    """ Same as bci file -o destination [-n] [--no-overwrite]
+
+    Returns:
+      A list of (filename, destination filename); nothing is moved if
+      dry_run. The list is empty if there were errors (which are logged),
+      so a dry run only lists moves that will be made.
+    """
+    if downloads==None:
+        downloads=[path.abspath(os.curdir)]
+    jobs, has_errors=archive_jobs(destination, downloads, overwrite=overwrite)
+    if has_errors:
+        return []
+    if not dry_run:
+        for filename, new_fullname in jobs:
+            ingest_file.move_xdev_file(filename, new_fullname, True)
+    return jobs
+
+def extract_worker(job):
+    """ Extracts files, in order, with one CONFIG importer in a worker
+    process
+
+    Args:
+      job: (index of importer in CONFIG, list of filenames)
+
+    Returns:
+      list of (entries or None if extract raised, text written to stderr)
+      for each file, and the importer's attributes after the last one
+    """
+    index, filenames = job
+    importer = CONFIG[index]
+    results = []
+    stderr = sys.stderr
+    try:
+        for filename in filenames:
+            sys.stderr = io.StringIO()
+            try:
+                entries = importer.extract(cache.get_file(filename))
+            except Exception:
+                entries = None
+            results.append((entries, sys.stderr.getvalue()))
+    finally:
+        sys.stderr = stderr
+    return results, ingest_cache.importer_state(importer.importer)
+
+def remove_option(argv, options):
+    """ Removes the first of options, and its value, from argv before
+    it is passed on to ingest
+    """
+    for idx,arg in enumerate(argv):
+        if arg in options:
+            del argv[idx:idx+2]
+            return
+        if arg.startswith('--') and arg.split('=')[0] in options:
+            del argv[idx]
+            return
+        if not arg.startswith('--') and arg[:2] in options:
+            del argv[idx] # e.g. -j4
+            return
+    return
+
+def move_downloads(argv, downloads, command="extract"):
+    """ Removes every -d/--downloads option from argv and puts downloads
+    back before command, the only place ingest accepts them
+    """
+    while True:
+        n=len(argv)
+        remove_option(argv, ['-d', '--downloads'])
+        if len(argv)==n:
+            break
+    idx=argv.index(command)
+    for download in reversed(downloads):
+        argv[idx:idx]=['-d', download]
+    return
+
+def prefetch_extracts(jobs, downloads=None):
+    """ Extracts the downloads in jobs processes before ingest does
+
+    Notes:
+      Importers keep attributes from one file to the next, so each one
+      extracts its files in order in one process, and importers run in
+      parallel. The entries are handed to the CONFIG importers, whose
+      extract() then returns them in the usual (lexical) file order.
+      Files whose extract raised are extracted again, in order, so the 
+      error is reported as usual.
+    """
+    if downloads==None:
+        downloads=[path.abspath(os.curdir)]
+    chains=OrderedDict() # importer index:[filenames]
+    for filename, matched in find_imports(CONFIG, downloads):
+        for importer in matched:
+            chains.setdefault(CONFIG.index(importer),[]).append(filename)
+    if jobs < 2 or len(chains) < 2:
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs,len(chains))) as pool:
+        for (index, filenames), (results, state) in zip(chains.items(), pool.map(extract_worker, chains.items())):
+            for filename, (entries, messages) in zip(filenames, results):
+                if entries!=None:
+                    CONFIG[index].prefetch(filename, entries, messages)
+            CONFIG[index].importer.__dict__.update(state)
+    return
+
+def extract_downloads(downloads=None):
+    """ Runs the matching importers on each download, like ingest extract
+
+    Returns:
+      A list of (filename, entries) pairs, in find_imports order
+    """
+    if downloads==None:
+        downloads=[path.abspath(os.curdir)]
+    if extract_jobs > 1:
+        prefetch_extracts(extract_jobs, downloads)
+    extracted_entries_list=[]
+    for filename, importers in find_imports(CONFIG, downloads):
+        for importer in importers:
+            try:
+                extracted_entries_list.append((filename, extract.extract_from_file(filename, importer)))
+            except Exception as exc:
+                logging.exception("Importer %s.extract() raised an unexpected error: %s", importer.name(), exc)
+    return extracted_entries_list
+
+def fresh_entries(extracted_entries_list):
+    """ Copies of the transactions, whose postings assignment changes
+    """
+    return [(fn,[e._replace(postings=list(e.postings)) if type(e)==data.Transaction else e for e in entries]) for fn,entries in extracted_entries_list]
+
+def print_entries(entries_list, output, existing=True):
+    """ Writes (filename, entries) pairs like ingest extract
+    """
+    if not existing:
+        if hasattr(accts, "auto_open"):
+            output.write('plugin "beancount.plugins.auto"\n')
+        output.write('option "booking_method" "FIFO"\n')
+    output.write(extract.HEADER)
+    for key, entries in entries_list:
+        output.write(identify.SECTION.format(key))
+        output.write('\n')
+        extract.print_extracted_entries(entries, output)
+    return
+
+def extract_accounts(jobs, downloads=None):
+    """ Extracts the downloads once and writes the new entries of several
+        accounts, same as running bci extract -e <ledger> -a <account>
+        for each one
+
+    Args:
+      jobs: list of (account filter, existing ledger file or None, output
+        file)
+      downloads: list of files or directories, None for the current one
+
+    Returns:
+      list of (account filter, output file, number of entries written)
+    """
+    global account_filter, ledger_index
+    EntryPrinter.META_IGNORE.add('__residual__')
+    ingest_cache.prune_cache()
+    extracted_entries_list=extract_downloads(downloads)
+    results=[]
+    for acct, ledger_file, output_file in jobs:
+        account_filter=acct
+        ledger_index=None
+        ledger_entries=None
+        if ledger_file and os.path.isfile(ledger_file):
+            if use_ledger_index and not importers.filters.assign.multi_posting_dedup:
+                ledger_index=get_ledger_index(ledger_file)
+            else:
+                ledger_entries, _, _ = loader.load_file(ledger_file)
+        else:
+            ledger_file=None
+        entries_list=process_extracted_entries(fresh_entries(extracted_entries_list), ledger_entries, downloads)
+        with open(output_file,'w') as f:
+            print_entries(entries_list, f, ledger_file!=None)
+        results.append((acct, output_file, sum([len(entries) for _,entries in entries_list])))
+    account_filter=None
+    ledger_index=None
+    return results
+
 if __name__=='__main__':
+
+	# extract all accounts of ledgersbyacct in accts.py in one process
+	if len(sys.argv) > 1 and sys.argv[1]=="extract_accounts":
+		parser = argparse.ArgumentParser()
+		parser.add_argument('extract_accounts')
+		parser.add_argument('-l','--ledgers',help='Directory of the existing <ledger>.bc files',required=False,default='..')
+		parser.add_argument('-o','--output',help='Directory for the <ledger>_new.bc files',required=False,default=path.join('..','staging'))
+		parser.add_argument('-j','--jobs',help='Number of processes extracting downloads',required=False,default=None,type=int)
+		parser.add_argument('-d','--downloads',help='Files or directories to extract (default current directory)',action='append',default=[])
+		clargs = parser.parse_args(sys.argv[1:])
+		if clargs.jobs!=None:
+			extract_jobs=clargs.jobs
+		if not hasattr(accts, "ledgersbyacct"):
+			sys.stderr.write("Can't find ledgersbyacct in accts.py\n")
+			sys.exit(1)
+		jobs=[]
+		for acct, filebase in accts.ledgersbyacct.items():
+			jobs.append((acct,path.join(clargs.ledgers,filebase+".bc"),path.join(clargs.output,filebase+"_new.bc")))
+		for acct, output_file, n in extract_accounts(jobs,[path.abspath(d) for d in clargs.downloads] or None):
+			sys.stderr.write("Wrote {0} entries for {1} to {2}\n".format(n,acct,output_file))
+		sys.exit(0)
 	
 	# some clean-ups for extract command
 	if "extract" in sys.argv:
 		parser = argparse.ArgumentParser()
 		extract.add_arguments(parser)
 		parser.add_argument('-a',help='Limit records to this account (useful with split ledgers',required=False,default=None)
+		parser.add_argument('-j','--jobs',help='Number of processes extracting downloads',required=False,default=None,type=int)
+		# passed on to ingest
+		parser.add_argument('-d','--downloads',help='Files or directories to extract (default current directory)',action='append',default=[])
 		parser.add_argument('extract')
 		clargs = parser.parse_args(sys.argv[1:])
+		if clargs.downloads:
+			ingest_downloads=[path.abspath(d) for d in clargs.downloads]
+			move_downloads(sys.argv,ingest_downloads)
+		if clargs.jobs!=None:
+			extract_jobs=clargs.jobs
+		# remove these toks from argv list to pass on to ingest
+		remove_option(sys.argv,['-j','--jobs'])
 		if clargs.a:
 			account_filter=clargs.a
 			# remove these toks from argv list to pass on to ingest
@@ -145,6 +460,15 @@ if __name__=='__main__':
 				print('plugin "beancount.plugins.auto"')
 			# TODO: make booking method configurable
 			print('option "booking_method" "FIFO"')
+		elif use_ledger_index and not importers.filters.assign.multi_posting_dedup:
+			# dedup against the ledger fingerprints, so remove the ledger
+			# from argv to keep ingest from loading it
+			ledger_index=get_ledger_index(clargs.existing)
+			remove_option(sys.argv,['-e','-f','--existing','--previous'])
 
 	EntryPrinter.META_IGNORE.add('__residual__')
+	if "extract" in sys.argv:
+		ingest_cache.prune_cache()
+	if "extract" in sys.argv and extract_jobs > 1:
+		prefetch_extracts(extract_jobs, ingest_downloads)
 	scripts_utils.ingest(CONFIG, hooks=[process_extracted_entries])
@@ -0,0 +1,57 @@
+# Accounts used and opened by extracted entries
+#
+# Account names are interned, so the sets and dicts below compare them by
+# identity first, and each name is kept only once however many postings
+# use it.
+
+import sys
+from beancount.core.data import Open, Transaction
+
+class AccountRegistry:
+	""" Accounts used by postings, in the order first seen, and accounts
+		with an Open entry
+
+		Arguments:
+			opened: accounts that are already open (e.g. in the ledger)
+
+		Notes:
+			Registries of several extracted files can be merged in file
+			order, e.g. when they were assigned in worker processes
+	"""
+	def __init__(self,opened=None):
+		self.used={} # account:None, a set that keeps insertion order
+		self.opened=set()
+		if opened:
+			self.opened.update([sys.intern(a) for a in opened])
+
+	def add(self,e):
+		""" Adds the posting accounts of a Transaction, or the account of 
+			an Open entry
+		"""
+		if type(e)==Transaction:
+			for p in e.postings:
+				if not p.account in self.used:
+					self.used[sys.intern(p.account)]=None
+		elif type(e)==Open:
+			self.opened.add(sys.intern(e.account))
+		return
+
+	def add_entries(self,entries):
+		for e in entries:
+			self.add(e)
+		return
+
+	def merge(self,other):
+		""" Adds the accounts of another registry after these
+		"""
+		for a in other.used:
+			if not a in self.used:
+				self.used[a]=None
+		self.opened.update(other.opened)
+		return
+
+	def unopened(self):
+		""" Returns: list of used accounts without an Open entry, in the 
+			order first used
+		"""
+		return([a for a in self.used if not a in self.opened])
@@ -5,23 +5,73 @@ from beancount.parser import printer
 from beancount.ingest.similar import find_similar_entries
 from beancount.core.data import D, Decimal, new_metadata
 from beancount.core import amount
-import numpy as np 
 import re
 import os,sys
-import yaml
+import glob
+import io
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime as dt
-from datetime import timedelta
 from collections import OrderedDict
 
+from beanjmw.importers.filters.rules import RuleMatcher, RuleProfiler
+from beanjmw.importers.filters.rulestore import rule_store
+from beanjmw.importers.filters.suggest import SuggestionIndex, narration_accounts
+from beanjmw.importers.filters.accounts import AccountRegistry
+from beanjmw.importers.filters.dedup import DedupIndex, PostingIndex
+from beanjmw.importers.filters.screen import screen_entries
+from beanjmw.importers.filters.unassigned import unassigned_store
+from beanjmw.importers.filters.cachefile import file_hash, load_pickle, save_pickle
+
 dir_path = "" # set this after import
 numeric_regex="[0-9]+"
 remove_duplicates=True
+# number of processes assigning extracted files in parallel, 1 is serial
+assign_workers=1
+# compare all postings of transactions when deduplicating (see PostingIndex)
+multi_posting_dedup=False
 remove_zero_value_transactions=True
 missing_payee_tag="UNASSIGNED"
-unassigned_file_mode="a" # make "a" for append
+# "a" merges new keys into existing *_unassigned.yaml files (each key is
+# written once), "w" replaces them with the keys of the last file
+unassigned_file_mode="a"
 quiet=True
+# cached group_regex tables are saved next to <Account>.yaml with this suffix
+group_cache_suffix="_groups.pickle"
+group_cache_version=1
+# RuleMatcher memos are saved next to <Account>.yaml with this suffix
+memo_suffix="_memo.pickle"
+memo_version=1
+# record rule match counts and regex times, and save them per account to
+# <Account>_profile.tsv next to <Account>.yaml
+profile_rules=False
+profile_suffix="_profile.tsv"
+# add the most likely account of each unassigned payee (from the rules of 
+# all accounts and the ledger) as a comment in <Account>_unassigned.yaml
+suggest_accounts=True
+suggest_min_score=0.3
 # top-level accounts - by definition
 top_accounts = ['Assets','Expenses','Liabilities','Income','Equity']
+# settings assign_file uses, by module, passed on to worker processes
+# (which only inherit settings changed after import, e.g. by bci from 
+# accts.py, when they are started with fork)
+worker_setting_names={
+	__name__:['dir_path','remove_zero_value_transactions','group_cache_suffix','memo_suffix','profile_rules','top_accounts'],
+	RuleMatcher.__module__:['rules_per_block','literal_rules','memo_size'],
+	type(rule_store).__module__:['disk_cache','cache_suffix'],
+}
+
+# compiled check number patterns, by numeric_regex
+check_patterns={}
+# narration of a check without a number (see assign_check_payees)
+counter_check=re.compile("CHECK$")
+
+def check_pattern():
+	""" Returns: compiled pattern that finds the check number in an upper
+		case narration
+	"""
+	if not numeric_regex in check_patterns:
+		check_patterns[numeric_regex]=re.compile('CHECK\\s+('+numeric_regex+')')
+	return(check_patterns[numeric_regex])
 
 def is_check(e):
 	""" Determines if it is a check from narration and returns check number
@@ -29,11 +79,26 @@ def is_check(e):
 	"""
 	cn = None
 	if type(e)==Transaction:
-		checkno_match = re.search('CHECK\\s+('+numeric_regex+')',e.narration.upper())
+		checkno_match = check_pattern().search(e.narration.upper())
 		if checkno_match:
 			cn=int(checkno_match.groups()[0])
 	return(cn)
 
+def check_numbers(entries):
+	""" Same as is_check for a whole list of entries
+		Returns: list of check number or None, one for each entry
+	"""
+	search=check_pattern().search
+	cns=[]
+	for e in entries:
+		cn=None
+		if type(e)==Transaction:
+			checkno_match=search(e.narration.upper())
+			if checkno_match:
+				cn=int(checkno_match.groups()[0])
+		cns.append(cn)
+	return(cns)
+
 def update_narration(e,payee,cn):
 	# format payee / memo / Check #
 	nsplt=e.narration.split('/')
@@ -62,17 +127,15 @@ def assign_check_payees(extracted_entries,account,filename=""):
 	check_file_prefix=account.replace(":","_")+"_payees"
 	check_file=os.path.join(dir_path,check_file_prefix+".yaml")
 	if os.path.isfile(check_file):
-		with open(check_file) as f:
-			payees_for_check=yaml.safe_load(f)
+		payees_for_check=rule_store.check_payees(check_file)
 	else:
 		sys.stderr.write("Warning: Can't find check number to payee file {0}\n".format(check_file))
 	
 	# assign payees on checks
 	new_entries=[] # list of entries
 	unassigned_checks={}
-	for e in extracted_entries:
+	for e,cn in zip(extracted_entries,check_numbers(extracted_entries)):
 		new_entry=e
-		cn = is_check(e)
 		if cn:
 			if cn in payees_for_check:
 				new_entry = update_narration(e, payees_for_check[cn], cn)
@@ -87,19 +150,15 @@ def assign_check_payees(extracted_entries,account,filename=""):
 						amt = e.postings[0].units
 					unassigned_checks[cn]=missing_payee_tag + " # " + e.date.isoformat()+","+str(amt)
 		# FIXME: special case for some banks - no check number
-		elif type(e)==Transaction and re.match("CHECK$",e.narration.upper()):
+		elif type(e)==Transaction and counter_check.match(e.narration.upper()):
 			new_entry=e._replace(narration="COUNTER CASH")
 		new_entries.append(new_entry)
 	# track unassigned checks
 	if len(unassigned_checks) > 0:
 		hints=len([x for x in unassigned_checks if missing_payee_tag in unassigned_checks[x]])
 		sys.stderr.write("Found {0} unassigned checks, {1} without hints for {2} ({3},{4} entries) for file {5}\n".format(len(unassigned_checks),str(hints),account,len(extracted_entries),len(new_entries),filename))
-		with open(os.path.join(dir_path,check_file_prefix+"_unassigned.yaml"),unassigned_file_mode) as f:
-			f.write("# Unassigned check payees for {0}\n".format(filename))
-			# order by check number, not item order
-			od=OrderedDict(sorted(unassigned_checks.items()))
-			for k,v in od.items():
-				f.write(str(k)+":"+(6-len(str(k)))*" "+v+"\n")
+		# written in check number order, not item order
+		unassigned_store.merge(os.path.join(dir_path,check_file_prefix+"_unassigned.yaml"),"# Unassigned check payees for {0}".format(filename),unassigned_checks,unassigned_file_mode=="w")
  
 	return(new_entries)
 
@@ -111,6 +170,25 @@ ry_chars=['#','*',',',"'",':','[',']','{','}','^','$','?','+','&','-','(',')']
 # TODO: make configurable
 annoying_prefixes=['Checkcard[ ]+[0-9]+ ','CHECKCARD[ ]+[0-9]+ ','Select Purchase. ','Debit Card Purchase. ','Sou ','ElectCHK [0-9]+ ','Cns ']
 
+# regexify tables, by (ry_chars, annoying_prefixes)
+regexify_tables_cache={}
+letter_regex=re.compile("[A-Za-z]+")
+number_run_regex=re.compile("[0-9]+")
+
+def regexify_tables():
+	""" Returns: (str.translate table for ry_chars, compiled 
+		annoying_prefixes) for the current settings
+	"""
+	key=(tuple(ry_chars),tuple(annoying_prefixes))
+	if not key in regexify_tables_cache:
+		table=str.maketrans({c:"." for c in ry_chars})
+		prefixes=[re.compile(p) for p in annoying_prefixes]
+		regexify_tables_cache[key]=(table,prefixes)
+	return(regexify_tables_cache[key])
+
+def generic_number(m):
+	return('[0-9]{'+str(m.end()-m.start())+'}')
+
 def regexify(s):
 	""" Replaces regex special characters that conflict with yaml
 		or do unwanted regex operations
@@ -118,46 +196,53 @@ def regexify(s):
 		Returns: cleaned up regex pattern that should work as yaml
 		Notes: Will replace all numbers with generic [0-9]{n} pattern 
 	"""
-	rets=s
-	if rets:
-		rets=s.strip()
-		if len(rets)==0:
-			return("EMPTY")
-		for c in ry_chars:
-			rets=rets.replace(c,".")
-		for p in annoying_prefixes:
-			ps=re.match(p, rets)
-			if ps:
-				rets=rets[ps.span()[1]:] # remove the prefix
-				break
-		# replace specific numbers with generic regex match
-		# If it is just a bunch of numbers, don't replace with generic
-		if not re.search("[A-Za-z]+",rets):
-			# explicit match, e.g. "A  / ..."
-			if len(rets) < 4 and len(rets) > 0: 
-				rets='^'+rets+'$' # '[ ]+/'
-			return(rets)
-		sp=0
-		if not "CHECK " in rets.upper(): # don't replace check numbers
-			# TODO: make better
-			while True:
-				sr=re.search('[0-9]+', rets[sp:])
-				if sr:
-					span=sr.span()
-					sl=rets[span[0]+sp:span[1]+sp]
-					nnum=span[1]-span[0]
-					tail_rets=rets[sp:].replace(sl,'[0-9]{'+str(nnum)+'}',1)
-					rets=rets[:sp]+tail_rets
-					repnum=7+len(str(nnum))
-					sp=sp+span[1]+(repnum-nnum) # rets could grow or shrink
-					if sp >= len(rets)-1:
-						break
-				else:
+	return(regexify_many([s])[0])
+
+def regexify_many(strings):
+	""" Same as regexify for a list of strings
+		Returns: list of patterns, one for each string
+		Notes: the tables are built once for the list, and repeated 
+			strings are only converted once
+	"""
+	table,prefixes=regexify_tables()
+	done={}
+	patterns=[]
+	for s in strings:
+		if type(s)==str and s in done:
+			patterns.append(done[s])
+			continue
+		rets=s
+		if rets:
+			rets=s.strip()
+			if len(rets)==0:
+				rets="EMPTY"
+				done[s]=rets
+				patterns.append(rets)
+				continue
+			rets=rets.translate(table)
+			for p in prefixes:
+				ps=p.match(rets)
+				if ps:
+					rets=rets[ps.end():] # remove the prefix
 					break
-	# final clean up
-	if len(rets) < 4 and len(rets) > 0: # make it an explicit match 
-		rets="^"+rets+'$' # "[ ]+/"
-	return(rets)
+			# replace specific numbers with generic regex match
+			# If it is just a bunch of numbers, don't replace with generic
+			if not letter_regex.search(rets):
+				# explicit match, e.g. "A  / ..."
+				if len(rets) < 4 and len(rets) > 0: 
+					rets='^'+rets+'$' # '[ ]+/'
+				done[s]=rets
+				patterns.append(rets)
+				continue
+			if not "CHECK " in rets.upper(): # don't replace check numbers
+				rets=number_run_regex.sub(generic_number,rets)
+		# final clean up
+		if len(rets) < 4 and len(rets) > 0: # make it an explicit match 
+			rets="^"+rets+'$' # "[ ]+/"
+		if type(s)==str:
+			done[s]=rets
+		patterns.append(rets)
+	return(patterns)
 
 def group_regex(yaml_dict):
 	""" Organizes regex patterns from simplest to most complex
@@ -186,6 +271,103 @@ def group_regex(yaml_dict):
 				return_dict[p1].append(p2)
 	return(return_dict)
 
+def update_group_regex(old_groups, yaml_dict):
+	""" Updates a group_regex table for a changed yaml file
+		
+		Arguments: old_groups, table returned by group_regex for the 
+			previous version of the file
+			yaml_dict, loaded from changed file
+
+		Returns: same dict as group_regex(yaml_dict)
+
+		Notes:
+			Patterns found in old_groups keep their old matches; only 
+			pairs that involve a new pattern are searched
+	"""
+	position={p:i for i,p in enumerate(yaml_dict)}
+	new_patterns=[p for p in yaml_dict if not p in old_groups]
+	return_dict={}
+	for p1 in yaml_dict:
+		if p1 in old_groups:
+			alts=[p2 for p2 in old_groups[p1] if p2 in position]
+			alts.extend([p2 for p2 in new_patterns if p1!=p2 and re.search(p1,p2)])
+			# keep file order, same as group_regex
+			alts.sort(key=position.get)
+		else:
+			alts=[p2 for p2 in yaml_dict if p1!=p2 and re.search(p1,p2)]
+		return_dict[p1]=alts
+	return(return_dict)
+
+def cached_group_regex(account_file, yaml_dict):
+	""" Same as group_regex, but saves the table next to the yaml file
+
+		Arguments: account_file, path of <Account>.yaml
+			yaml_dict, loaded from account_file
+
+		Returns: dict from group_regex
+
+		Notes:
+			The cache is used as-is if the mtime and size of the yaml file
+			are unchanged, or if its content hash is unchanged. Otherwise
+			only the rules that changed are re-grouped.
+	"""
+	cache_file=os.path.splitext(account_file)[0]+group_cache_suffix
+	st=os.stat(account_file)
+	cache=load_pickle(cache_file,group_cache_version,"group cache")
+	if cache and cache['mtime']==st.st_mtime_ns and cache['size']==st.st_size:
+		return(cache['groups'])
+	digest=file_hash(account_file)
+	if cache and cache['hash']==digest:
+		groups=cache['groups']
+	elif cache:
+		groups=update_group_regex(cache['groups'],yaml_dict)
+	else:
+		groups=group_regex(yaml_dict)
+	# files of the same account may be assigned in parallel
+	save_pickle(cache_file,group_cache_version,{'mtime':st.st_mtime_ns,'size':st.st_size,'hash':digest,'groups':groups},"group cache")
+	return(groups)
+
+def load_memo(account_file):
+	""" Loads the saved RuleMatcher memo of an account yaml file
+		Returns: dict of (payee, category):pattern, empty if the yaml
+			file changed since the memo was saved
+	"""
+	memo_file=os.path.splitext(account_file)[0]+memo_suffix
+	saved=load_pickle(memo_file,memo_version,"memo")
+	if saved==None:
+		return({})
+	st=os.stat(account_file)
+	if saved['mtime']==st.st_mtime_ns and saved['size']==st.st_size:
+		return(saved['memo'])
+	if saved['hash']==file_hash(account_file):
+		return(saved['memo'])
+	return({})
+
+def save_memo(account_file, memo):
+	""" Saves a RuleMatcher memo next to the account yaml file
+	"""
+	memo_file=os.path.splitext(account_file)[0]+memo_suffix
+	st=os.stat(account_file)
+	save_pickle(memo_file,memo_version,{'mtime':st.st_mtime_ns,'size':st.st_size,'hash':file_hash(account_file),'memo':dict(memo)},"memo")
+	return
+
+def warm_group_cache(yaml_dir):
+	""" Builds or refreshes the group cache of every account yaml file
+		in yaml_dir, so the next extract doesn't have to
+		Returns: list of yaml files cached
+	"""
+	warmed=[]
+	for account_file in sorted(glob.glob(os.path.join(yaml_dir,"*.yaml"))):
+		# only regex rule files, not check numbers or unassigned
+		if "_unassigned" in account_file or account_file.endswith("_payees.yaml"):
+			continue
+		assignLUT=rule_store.load(account_file)
+		if not assignLUT or not all([type(k)==str for k in assignLUT]):
+			continue
+		cached_group_regex(account_file,assignLUT)
+		warmed.append(account_file)
+	return(warmed)
+
 def best_match(e,pattern,alt_list):
 	""" Finds best match for this pattern given a list of possible all_entries
 		Args: entry, string pattern, and list of alt patterns
@@ -234,41 +416,54 @@ def update_posting(e,account):
 		e.postings[1]=new_posting
 	return
 
-def assign_entry(e, assignLUT, assign_groups):
+def assign_entry(e, assignLUT, assign_groups, matcher=None):
 	""" Tries to assign an entry to an account using patterns
 		Arguments: 
 			e (entry), 
 			assignLUT (dict of patterns:account),
 			assign_groups: grouping of patterns from least to most complex
+			matcher: RuleMatcher compiled from assignLUT and assign_groups
+				(optional, but build it once per account if assigning
+				many entries)
 		Returns: True if assigned, False otherwise
 	"""
-	# FIXME: Compile and turn pattern into one long reference
+	if matcher==None:
+		matcher=RuleMatcher(assignLUT, assign_groups)
 	assigned = False
-	for pattern in assignLUT:
-		best_pattern = best_match(e, pattern, assign_groups[pattern])
-		if len(best_pattern) > 0:
-			update_posting(e, assignLUT[best_pattern])
-			assigned = True
-			break
+	# try 'payee' part of payee / memo / Check #
+	id_str = e.narration.split(' / ')[0].strip() 
+	best_pattern = matcher.match(id_str, e.meta.get('category'))
+	if len(best_pattern) > 0:
+		update_posting(e, assignLUT[best_pattern])
+		assigned = True
 	return(assigned)
 
-def update_unassigned(e, unassigned_payees):
+def unassigned_payee(e):
+	""" Returns: payee of an entry that wasn't assigned, from the 
+		narration or else the category
+	"""
+	unassigned_payee="EMPTY"
+	if 'category' in e.meta:
+		unassigned_payee=e.meta['category']
+	# first is always payee
+	tok=e.narration.split('/')[0].strip() 
+	if len(tok)!=0: # use 1st field of narration 
+		unassigned_payee=tok
+	return(unassigned_payee)
+
+def update_unassigned(e, unassigned_payees, reg_key=None):
 	""" Updates the unassigned table
+		Arguments: reg_key = regexify(unassigned_payee(e)) if already known
 	"""
 	pre_assigned_category="Expenses:UNASSIGNED"
-	unassigned_payee="EMPTY"
 	if 'category' in e.meta:
 		# if it is a valid top-level account, use as-is
 		if e.meta['category'].split(':')[0] in top_accounts:
 			pre_assigned_category=e.meta['category']
 		else: # else assume it is an Expense
 			pre_assigned_category=':'.join(["Expenses",e.meta['category']])
-		unassigned_payee=e.meta['category']
-	# first is always payee
-	tok=e.narration.split('/')[0].strip() 
-	if len(tok)!=0: # use 1st field of narration 
-		unassigned_payee=tok
-	reg_key = regexify(unassigned_payee)
+	if reg_key==None:
+		reg_key = regexify(unassigned_payee(e))
 	if reg_key in unassigned_payees and pre_assigned_category!=unassigned_payees[reg_key]:
 		sys.stderr.write("Warning: Ambiguous regex key {0}: was {1} now {2}\n".format(reg_key,unassigned_payees[reg_key],pre_assigned_category))
 		# the original reg key is ambiguous, so create key from cat
@@ -290,83 +485,245 @@ def update_unassigned(e, unassigned_payees):
 	unassigned_payees[reg_key]=pre_assigned_category
 	return
 
-def save_unassigned(unassigned_payees,account_file,ex_file):
-	""" Saves unassigned payees to appended yaml file
+def suggestion_index(ledger_entries):
+	""" Builds a SuggestionIndex from the yaml rules of all accounts in
+		dir_path and the payees of the ledger
+		Arguments: ledger_entries = list of entries, DedupIndex or None
 	"""
-	oup=OrderedDict(sorted(unassigned_payees.items()))
+	index=SuggestionIndex()
+	for rule_file in sorted(glob.glob(os.path.join(dir_path,"*.yaml"))):
+		if "_unassigned" in rule_file or rule_file.endswith("_payees.yaml"):
+			continue
+		try:
+			index.add_rules(rule_store.load(rule_file))
+		except Exception as ex:
+			sys.stderr.write("Warning: no suggestions from {0}: {1}\n".format(rule_file,ex))
+	if isinstance(ledger_entries,DedupIndex):
+		index.add_history(ledger_entries.history)
+	elif ledger_entries:
+		index.add_history(narration_accounts(ledger_entries))
+	return(index)
+
+def save_unassigned(unassigned_payees,account_file,ex_file,suggestions=None):
+	""" Merges unassigned payees into the <Account>_unassigned.yaml file
+		Arguments: suggestions = SuggestionIndex to add a comment with the
+			likely account of UNASSIGNED payees
+		Notes: payees already in the file keep their first value
+	"""
+	oup={}
+	for k,v in unassigned_payees.items():
+		comment=""
+		if suggestions and "UNASSIGNED" in v:
+			account,score=suggestions.suggest(k)
+			if account and score >= suggest_min_score:
+				comment=" # suggest {0} ({1:.2f})".format(account,score)
+		oup[k]=v+comment
 	if len(oup) > 0:
-		with open(os.path.splitext(account_file)[0]+"_unassigned.yaml",unassigned_file_mode) as f:
-			f.write("# Unassigned accounts for {0}\n".format(ex_file)) 
-			for k in oup:
-				if len(k) < 40:
-					f.write("\""+k+"\"" + ":" + (40-len(k))*" " + oup[k] + "\n")
-				else: # really long key...
-					f.write("\""+k+"\"" + ": " + oup[k] + "\n")
+		unassigned_store.merge(os.path.splitext(account_file)[0]+"_unassigned.yaml","# Unassigned accounts for {0}".format(ex_file),oup,unassigned_file_mode=="w")
 	return
 
 def auto_open(entry_list):
 	''' Removes open statements - problematic for deduplicate
 	'''
-	new_entry_list=[]
+	return(list(auto_open_iter(entry_list)))
+
+def auto_open_iter(entry_list):
+	''' Same as auto_open, one (fn, entries) pair at a time
+	'''
 	for fn, entries in entry_list:
-		new_entries = []
-		for e in entries:
-			if type(e) == Open:
-				continue
-			new_entries.append(e)
-		new_entry_list.append((fn, new_entries))
-	return(new_entry_list)
+		yield((fn, [e for e in entries if type(e) != Open]))
+	return
+
+def assign_file(entries,account_file):
+	""" Assigns accounts to the entries of one extracted file
+		Arguments:
+			entries: list of entries, postings are updated in place
+			account_file: <account>.yaml file with the assignment rules
+		Returns:
+			(entries, dict of unassigned payees, AccountRegistry of the
+			accounts the entries use and open,
+			rule profile or None - see merge_rule_profile)
+	"""
+	# links payees/narration to account 
+	assignLUT={}
+	assign_groups={}
+	unassigned_payees={}
+	registry=AccountRegistry()
+	memo={}
+	compiled={}
+	if os.path.isfile(account_file):
+		assignLUT=rule_store.load(account_file)
+		assign_groups=cached_group_regex(account_file,assignLUT)
+		compiled=rule_store.compiled(account_file)
+		memo=load_memo(account_file)
+	if profile_rules:
+		matcher=RuleProfiler(assignLUT,assign_groups,compiled=compiled)
+	else:
+		matcher=RuleMatcher(assignLUT,assign_groups,memo,compiled)
+	unassigned=[]
+	# only unbalanced transactions need an account
+	zero,needs_account=screen_entries(entries)
+	for e,z,u in zip(entries,zero,needs_account):
+		# skip zero value entries - lots of these in CC's
+		if u and not (z and remove_zero_value_transactions):
+			if not assign_entry(e,assignLUT,assign_groups,matcher):
+				unassigned.append(e)
+	registry.add_entries(entries)
+	reg_keys=regexify_many([unassigned_payee(e) for e in unassigned])
+	for e,reg_key in zip(unassigned,reg_keys):
+		update_unassigned(e,unassigned_payees,reg_key)
+	if matcher.memo_changed and os.path.isfile(account_file):
+		save_memo(account_file,matcher.memo)
+	profile=None
+	if profile_rules:
+		profile={
+			'stats':matcher.stats,
+			'accounts':assignLUT,
+			'literal':set(matcher.patterns[i] for i in matcher.lengths),
+			'literal_searches':matcher.literal_searches,
+			'literal_seconds':matcher.literal_seconds,
+		}
+	return(entries,unassigned_payees,registry,profile)
+
+def merge_rule_profile(profile,other):
+	""" Adds the counts and times of other to profile, for two files 
+		of the same account
+		Returns: merged profile
+	"""
+	if profile==None:
+		return(other)
+	for p,st in other['stats'].items():
+		if p in profile['stats']:
+			profile['stats'][p]=[a+b for a,b in zip(profile['stats'][p],st)]
+		else:
+			profile['stats'][p]=st
+	profile['literal_searches']+=other['literal_searches']
+	profile['literal_seconds']+=other['literal_seconds']
+	return(profile)
+
+def save_rule_profile(account_file,profile):
+	""" Writes the rule profile of an account as a tab separated file
+		next to the yaml file, one row per rule in file order
+		Returns: name of profile file
+	"""
+	profile_file=os.path.splitext(account_file)[0]+profile_suffix
+	with open(profile_file,'w') as f:
+		f.write("\t".join(["pattern","account","kind"]+RuleProfiler.columns+["us_per_search"])+"\n")
+		for p,st in profile['stats'].items():
+			kind="regex"
+			if p in profile['literal']:
+				kind="literal"
+			per_search=""
+			if st[4] > 0:
+				per_search="{0:.1f}".format(1e6*st[5]/st[4])
+			f.write("\t".join([p,str(profile['accounts'].get(p,"")),kind]+[str(x) for x in st[:5]]+["{0:.6f}".format(st[5]),per_search])+"\n")
+		f.write("# literal rules: {0} searches, {1:.6f} seconds\n".format(profile['literal_searches'],profile['literal_seconds']))
+	dead=len([p for p,st in profile['stats'].items() if st[0]==0 and st[1]==0])
+	sys.stderr.write("Rule profile {0}: {1} of {2} rules never matched\n".format(profile_file,dead,len(profile['stats'])))
+	return(profile_file)
+
+def worker_settings():
+	""" Returns: dict of module name:{setting:value} of worker_setting_names
+	"""
+	return({m:{k:getattr(sys.modules[m],k) for k in names} for m,names in worker_setting_names.items()})
+
+def apply_worker_settings(settings):
+	for m,values in settings.items():
+		for k,v in values.items():
+			setattr(sys.modules[m],k,v)
+	return
+
+def assign_file_worker(job):
+	""" assign_file in a worker process
+		Arguments: job = (entries, account_file, worker_settings())
+		Returns: assign_file results plus the text written to stderr, 
+			which the parent writes in file order
+	"""
+	entries,account_file,settings=job
+	apply_worker_settings(settings)
+	stderr=sys.stderr
+	sys.stderr=io.StringIO()
+	try:
+		ret=assign_file(entries,account_file)
+		return(ret+(sys.stderr.getvalue(),))
+	finally:
+		sys.stderr=stderr
 
 def assign_accounts(extracted_entries_list,ledger_entries,filename_accounts):
 	""" Assigns accounts from payee field and open any new accounts
+		Notes: 
+			Files are assigned in assign_workers processes if more than 
+			one; the output, unassigned yaml files and messages are the
+			same as assigning them one after the other
+	"""
+	return(new_opens_first(assign_accounts_iter(zip(extracted_entries_list,filename_accounts),ledger_entries)))
+
+def new_opens_first(entries_list):
+	""" Moves the ("new_opens", entries[]) pair that assign_accounts_iter
+		yields last to the front
+		Returns: list of (file, entries[]) pairs, after the last file
+	"""
+	entries_list=list(entries_list)
+	return(entries_list[-1:]+entries_list[:-1])
+
+def assign_accounts_iter(files,ledger_entries):
+	""" Same as assign_accounts, one file at a time
+		Arguments:
+			files: iterable of ((file, entries[]), (file, account)) pairs
+			ledger_entries: list of entries from ledger, or its DedupIndex
+		Returns:
+			generator of (file, entries[]) pairs, as each file is assigned
+			(entries are updated in place), and ("new_opens", entries[]) last
 	"""
 # now assign possible missing postings
 # grab accounts from all postings so far
-	new_entries=[] # list of (file, entries[]) tuples
-	opened_accounts=[]
-	if ledger_entries:
-		opened_accounts=[e.account for e in ledger_entries if type(e)==Open]
-	for (ex_file,entries),(fn,account) in zip(extracted_entries_list,filename_accounts):
-		# links payees/narration to account 
-		assignLUT={}
-		assign_groups={}
-		unassigned_payees={}
-		# default account file name for unassigned
-		account_file=os.path.join(dir_path,account.replace(':','_')+".yaml")
-		if os.path.isfile(account_file):
-			with open(account_file,'r') as f:
-				assignLUT=yaml.safe_load(f)
-				assign_groups=group_regex(assignLUT)
-		new_entries.append((ex_file,[]))
-		for en,e in enumerate(entries):
-			# check for zero value entries - lots of these in CC's
-			if type(e)==Transaction and len(e.postings)==1 and e.postings[0].units[0]==0 and remove_zero_value_transactions: 
-				continue
-			if type(e)==Transaction and unbalanced(e.postings):
-				if not assign_entry(e,assignLUT,assign_groups):
-					update_unassigned(e,unassigned_payees)
-			if type(e)==Open:
-				if not e.account in opened_accounts:
-					opened_accounts.append(e.account)
-
-		if len(unassigned_payees) > 0:
-			sys.stderr.write("Found {0} unassigned accounts for {1} ({2} entries) for file {3}\n".format(len(unassigned_payees),account,len(entries),ex_file))
-			save_unassigned(unassigned_payees,account_file,ex_file)
-
-		new_entries[-1][1].extend(entries)
-
-	# see what accounts we have
-	account_list=[]
-	for ex_file, entries in extracted_entries_list:
-		for e in entries:
-			if type(e)==Transaction:
-				for p in e.postings:
-					if not p.account in account_list:
-						account_list.append(p.account)
+	if isinstance(ledger_entries,DedupIndex): # saved ledger index
+		accounts=AccountRegistry(ledger_entries.open_accounts())
+	elif ledger_entries:
+		accounts=AccountRegistry([e.account for e in ledger_entries if type(e)==Open])
+	else:
+		accounts=AccountRegistry()
+	# (file, account, account yaml file, entries)
+	# default account file name for unassigned
+	jobs=((ex_file,account,os.path.join(dir_path,account.replace(':','_')+".yaml"),entries) for (ex_file,entries),(fn,account) in files)
+	pool=None
+	if assign_workers > 1:
+		jobs=list(jobs)
+	if assign_workers > 1 and len(jobs) > 1:
+		pool=ProcessPoolExecutor(max_workers=min(assign_workers,len(jobs)))
+		settings=worker_settings()
+		results=zip(jobs,pool.map(assign_file_worker,[(entries,account_file,settings) for _,_,account_file,entries in jobs]))
+	else:
+		results=((job,assign_file(job[3],job[2])+("",)) for job in jobs)
+	profiles=OrderedDict() # by account file
+	suggestions=None # built for the first unassigned payees
+	try:
+		for (ex_file,account,account_file,_),result in results:
+			entries,unassigned_payees,registry,profile,messages=result
+			if profile:
+				profiles[account_file]=merge_rule_profile(profiles.get(account_file),profile)
+			sys.stderr.write(messages)
+			accounts.merge(registry)
+
+			if len(unassigned_payees) > 0:
+				sys.stderr.write("Found {0} unassigned accounts for {1} ({2} entries) for file {3}\n".format(len(unassigned_payees),account,len(entries),ex_file))
+				if suggest_accounts and suggestions==None:
+					suggestions=suggestion_index(ledger_entries)
+				save_unassigned(unassigned_payees,account_file,ex_file,suggestions)
+
+			yield((ex_file,entries))
+	finally:
+		if pool:
+			pool.shutdown()
+	for account_file,profile in profiles.items():
+		if len(profile['stats']) > 0: # no report without rules
+			save_rule_profile(account_file,profile)
+
 	# open accounts that aren't already open
-	open_entries=[Open(new_metadata("fn",0),dt.date(dt.fromisoformat(default_account_open_date)),a,["USD"],None) for a in account_list if not a in opened_accounts]
+	open_entries=[Open(new_metadata("fn",0),dt.date(dt.fromisoformat(default_account_open_date)),a,["USD"],None) for a in accounts.unopened()]
 
-	return([("new_opens",open_entries)]+new_entries)
+	yield(("new_opens",open_entries))
+	return
 
 def unbalanced(postings):
 	""" Returns true of transaction is unbalanced
@@ -388,18 +745,31 @@ def deduplicate(extracted_entries_list,ledger_entries):
 	""" Removes or marks entries if they exist in another ingest or ledger
 		Arguments:
 			extracted_entries_list: [(fn,entries[])] list from ingest
-			ledger_entries: list of entries from ledger
+			ledger_entries: list of entries from ledger, or its DedupIndex
 		Returns:
 			Possibly modified extracted_entries_list
 	"""
+	return(list(deduplicate_iter(extracted_entries_list,ledger_entries)))
+
+def deduplicate_iter(extracted_entries_list,ledger_entries):
+	""" Same as deduplicate, one (fn,entries[]) pair at a time
+		Arguments:
+			extracted_entries_list: iterable of (fn,entries[]) pairs
+			ledger_entries: list of entries from ledger, or its DedupIndex
+		Notes:
+			Each list is compared to all the lists after it, so the pairs
+			are gathered first (the entries themselves are not copied) and
+			the first pair is yielded after the last one is read.
+			The index only keeps the fingerprints of extracted entries.
+			With nothing to compare (one file, no ledger) the pairs are
+			passed through.
+	"""
+	extracted_entries_list=list(extracted_entries_list)
 	# all_entries is a list of entry lists, one list for each file
 	all_entries_list=[x[1] for x in extracted_entries_list]
 	# if we have a ledger, add this list as the last one
 	if ledger_entries:
 		all_entries_list.append(ledger_entries)
-	# need at least two entry lists to compare...
-	if len(all_entries_list)<2:
-		return([[[] for _ in range(len(extracted_entries_list[0][1]))]])
 	#
 	# Compare the list of ingested to each other, and possibly an existing 
 	# ledger
@@ -414,71 +784,83 @@ def deduplicate(extracted_entries_list,ledger_entries):
 	# We also don't need to compare records within an extracted account
     # as duplicates should not occurr
 	#
-	duplicates=[]
-	for i,a in enumerate(all_entries_list[:-1]):
-		a_groups=[]
-		for b in all_entries_list[i+1:]:
-			a_groups.append(compare_entries(a, b))
-		
-		# entries_a might have been compared to multiple other entry lists
-		dl_a=[[] for _ in range(len(a))]
-		for i,dl in enumerate(dl_a): 
-			for ag in a_groups:
-				dl.extend(ag[i])
-		duplicates.append(dl_a)		
-
-    # Do something about duplicates
-	deduped_entries_list=[]
-
-	for fn_entries,dups in zip(extracted_entries_list,duplicates):
-		deduped_entries_list.append((fn_entries[0],[]))
-		for e,d in zip(fn_entries[1],dups):
-			ne=e
-			if len(d) > 0: # have at least one duplicate
+	# All lists go into one index, tagged with their position in 
+	# all_entries_list, and each entry is a duplicate of the indexed entries
+	# from later lists. An already indexed ledger is looked up on its own.
+	ledger_index=None
+	if isinstance(ledger_entries,(DedupIndex,PostingIndex)):
+		ledger_index=all_entries_list.pop()
+	if multi_posting_dedup:
+		entries=[]
+		tags=[]
+		for i,lst in enumerate(all_entries_list):
+			if i > 0: # nothing is compared to the first list
+				entries.extend(lst)
+				tags.extend([i]*len(lst))
+		index=PostingIndex(entries,tags)
+	else:
+		index=DedupIndex()
+		for i,lst in enumerate(all_entries_list):
+			if i > 0:
+				index.add_entries(lst,fingerprint=True,tag=i)
+
+	for i,(fn,entries) in enumerate(extracted_entries_list):
+		if ledger_index==None and i==len(all_entries_list)-1:
+			# last list has no later lists (no ledger), pass it through
+			yield((fn,entries))
+			break
+		deduped_entries=[]
+		for e in entries:
+			d=[ne for t,ne in index.duplicates(e) if t > i]
+			if len(d)==0 and ledger_index!=None:
+				d=ledger_index.duplicates(e)
+			if len(d)==0:
+				deduped_entries.append(e)
+				continue
+			# have at least one duplicate
+#			sys.stderr.write("Found dup: {0} {1}\n".format(e,d))
+			ident=duplicate_ident(e)
+			if not remove_duplicates:
 				ne=e._replace(meta={"mark":"Duplicate"})
-#				sys.stderr.write("Found dup: {0} {1}\n".format(ne,d))
-				if type(ne)==Transaction:
-					acct="Empty"
-					units="Empty"
-					if ne.postings and len(ne.postings) > 0:
-						acct = ne.postings[0].account
-						units=str(ne.postings[0].units)
-					ident= acct + " " + units + " " + ne.narration
-				elif type(ne)==Open:
-					ident="Open: " + ne.account
-				elif type(ne)==Balance:
-					ident="Balance: " + ne.account
-				elif type(ne)==Commodity:
-					ident="Commodity: " + ne.currency
-				elif type(ne)==Price:
-					ident="Price: " + ne.currency
-				else:
-					ident=str(type(ne))
-				if not remove_duplicates:
-					msg="Marked dup {0} {1}\n".format(ne.date,ident)
-					sys.stderr.write(msg)
-					deduped_entries_list[-1][1].append(ne)
-				else:
-					msg="Removed dup {0} {1}\n".format(ne.date,ident)
-					if not quiet:
-						sys.stderr.write(msg)
-#					ne=Note({'orig':ne.narration},ne.date,ne.postings[0].account,'Dup is {0} {1} {2}'.format(str(d[0].date),d[0].postings[0].account,d[0].narration))
-#					deduped_entries_list[-1][1].append(ne)
+				msg="Marked dup {0} {1}\n".format(ne.date,ident)
+				sys.stderr.write(msg)
+				deduped_entries.append(ne)
 			else:
-				deduped_entries_list[-1][1].append(ne)
-
-    # have to tack on last set if multiple files ingested with no ledger
-	if ledger_entries==None and len(extracted_entries_list)>1:
-		deduped_entries_list.append(extracted_entries_list[-1])
-		
-	return(deduped_entries_list)
+				msg="Removed dup {0} {1}\n".format(e.date,ident)
+				if not quiet:
+					sys.stderr.write(msg)
+#				ne=Note({'orig':ne.narration},ne.date,ne.postings[0].account,'Dup is {0} {1} {2}'.format(str(d[0].date),d[0].postings[0].account,d[0].narration))
+#				deduped_entries.append(ne)
+		yield((fn,deduped_entries))
+	return
 
-compare_delta = Decimal("0.0100001")
+def duplicate_ident(ne):
+	""" Returns: short description of a duplicate entry for messages
+	"""
+	if type(ne)==Transaction:
+		acct="Empty"
+		units="Empty"
+		if ne.postings and len(ne.postings) > 0:
+			acct = ne.postings[0].account
+			units=str(ne.postings[0].units)
+		ident= acct + " " + units + " " + ne.narration
+	elif type(ne)==Open:
+		ident="Open: " + ne.account
+	elif type(ne)==Balance:
+		ident="Balance: " + ne.account
+	elif type(ne)==Commodity:
+		ident="Commodity: " + ne.currency
+	elif type(ne)==Price:
+		ident="Price: " + ne.currency
+	else:
+		ident=str(type(ne))
+	return(ident)
 
 def compare_entries(entries_a,entries_b):
 	""" Compares two lists of entries to see if there are duplicates 
 		Arguments: 
 			entries_a,entries_b: lists of entries to compare
+				entries_b can also be a DedupIndex (e.g. of the ledger)
 		Returns:
 			lists of duplicates, one list for each entry in entries_a
 		Notes:
@@ -486,56 +868,16 @@ def compare_entries(entries_a,entries_b):
 			create a 3rd account (e.g. Expenses:Card:Payment) that should sum
 			to zero - otherwise removing one of them will cause problems on 
 			re-ingesting
+			See dedup.py for what counts as a duplicate
+			Only the first posting is compared, which can fail for two e.g. 
+			Cash transactions of the same amount on the same day (e.g. 
+			buying $10 of X and $10 of Y) - set multi_posting_dedup to 
+			compare all postings
 	"""
-	# this is what gets returned
-	duplicate_list=[[] for _ in range(len(entries_a))]
-	dateval_a=[]
-	dateval_b=[]
-	# TODO: Use pytz and convert to UTC 
-	# beancount doesnt use full times, only dates
-	for e in entries_a:
-		dateval_a.append(dt.timestamp(dt.fromisoformat(str(e.date))))	
-	for e in entries_b:
-		dateval_b.append(dt.timestamp(dt.fromisoformat(str(e.date))))	
-	td1=3600*24 # 1 day in seconds
-	dateval_a=np.array(dateval_a)
-	dateval_b=np.array(dateval_b)
-	for ea,da,dl in zip(entries_a,dateval_a,duplicate_list):
-		f=(dateval_b>=(da-td1))&(dateval_b<=(da+td1))
-		near_entries=[entries_b[i] for i,fi in enumerate(f) if fi]
-		if type(ea)==Transaction:
-			aa=None
-			va=None
-			# FIXME: This can fail for two e.g. Cash transactions of the
-			# same amount on the same day (e.g. buying $10 of X and $10 of Y)
-			# Need to check all postings of transaction
-			if len(ea.postings) > 0:
-				aa=ea.postings[0].account
-				va=ea.postings[0].units 
-			for ne in near_entries:
-				if type(ne)==Transaction:
-					ne_ts=dt.timestamp(dt.fromisoformat(str(ne.date)))
-					vn=None
-					for p in ne.postings:
-						if p.account==aa:
-							vn=p.units
-					# date, amount, and accounts match
-					if vn and va and vn.currency==va.currency and abs(vn.number-va.number) < compare_delta and ne_ts==da: 
-						dl.append(ne)
-		elif type(ea)==Balance or type(ea)==Open: 
-			for ne in near_entries:
-				if type(ne)==type(ea):
-					if ea.account==ne.account and ea.date==ne.date:
-						dl.append(ne)
-		elif type(ea)==Commodity or type(ea)==Price:
-			for ne in near_entries:
-				if type(ne)==type(ea):
-					if ea.currency==ne.currency and ea.date==ne.date:
-						dl.append(ne)
-		elif type(ea)==Event:
-			for ne in near_entries:
-				if type(ne)==type(ea):
-					if ea.type==ne.type and ea.date==ne.date and ea.description==ne.description:
-						dl.append(ne)
-
-	return(duplicate_list)
+	if isinstance(entries_b,(DedupIndex,PostingIndex)):
+		index=entries_b
+	elif multi_posting_dedup:
+		index=PostingIndex(entries_b)
+	else:
+		index=DedupIndex(entries_b)
+	return([index.duplicates(ea) for ea in entries_a])
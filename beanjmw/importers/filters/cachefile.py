@@ -0,0 +1,76 @@
+# Helpers for the files the filters and bci keep to skip work next time
+#
+# Group tables, memos, parsed yaml (next to <Account>.yaml), ledger dedup
+# indexes (next to <ledger>.bc), ingest caches and unassigned yaml files
+# are all written to a per-process temporary file that then replaces the
+# file, so other processes never read a partly written file. Pickled
+# files are dicts with a 'version' key, older versions are ignored.
+
+import os, sys
+import hashlib
+import pickle
+
+def file_signature(filename):
+	""" Returns: (mtime_ns, size) of a file, a cheap check for changes
+	"""
+	st=os.stat(filename)
+	return((st.st_mtime_ns,st.st_size))
+
+def file_hash(filename,size=None):
+	""" Returns: sha256 hex digest of the contents of a file, or of its 
+		first size bytes
+	"""
+	h=hashlib.sha256()
+	with open(filename,'rb') as f:
+		while size==None or size > 0:
+			block=f.read(1<<20 if size==None else min(1<<20,size))
+			if not block:
+				break
+			h.update(block)
+			if size!=None:
+				size-=len(block)
+	return(h.hexdigest())
+
+def write_atomic(filename,write,mode='wb'):
+	""" Calls write(f) with a temporary file, then replaces filename with it
+		Notes: raises on errors, after removing the temporary file
+	"""
+	tmp_file=filename+".{0}.tmp".format(os.getpid())
+	try:
+		with open(tmp_file,mode) as f:
+			write(f)
+		os.replace(tmp_file,filename)
+	except BaseException:
+		if os.path.isfile(tmp_file):
+			os.remove(tmp_file)
+		raise
+	return
+
+def load_pickle(filename,version,description="cache"):
+	""" Returns: dict saved by save_pickle, or None if there isn't one with
+		this version
+		Notes: files that can't be read are ignored with a warning
+	"""
+	if not os.path.isfile(filename):
+		return(None)
+	try:
+		with open(filename,'rb') as f:
+			data=pickle.load(f)
+		if data['version']==version:
+			return(data)
+	except Exception as ex:
+		sys.stderr.write("Warning: ignoring {0} {1}: {2}\n".format(description,filename,ex))
+	return(None)
+
+def save_pickle(filename,version,data,description="cache"):
+	""" Pickles dict data, with its version, with write_atomic
+		Returns: True if saved, otherwise warns
+	"""
+	data=dict(data,version=version)
+	try:
+		os.makedirs(os.path.dirname(filename) or os.curdir,exist_ok=True)
+		write_atomic(filename,lambda f: pickle.dump(data,f))
+		return(True)
+	except Exception as ex:
+		sys.stderr.write("Warning: can't save {0} {1}: {2}\n".format(description,filename,ex))
+	return(False)
@@ -0,0 +1,480 @@
+# Duplicate detection for extracted entries
+#
+# Entries are duplicates if they have the same type and date and:
+#	Transaction: the first posting of one has the same account, currency
+#		and amount (within compare_delta) as a posting of the other
+#	Open, Balance: same account
+#	Commodity, Price: same currency
+#	Event: same event type and description
+#
+# PostingIndex (assign.multi_posting_dedup) compares all postings of
+# transactions instead of only the first one
+
+from beancount.core.data import Open,Transaction,Balance,Commodity,Price,Event
+from beancount.core.data import Decimal, Amount
+from decimal import ROUND_FLOOR
+from beancount import loader
+from beancount.parser import parser
+import os
+import pickle
+import numpy as np
+from collections import Counter
+
+from beanjmw.importers.filters.suggest import narration_accounts
+from beanjmw.importers.filters.cachefile import file_signature, file_hash, load_pickle, save_pickle
+import hashlib
+import math
+
+compare_delta = Decimal("0.0100001")
+
+# saved fingerprint index of a ledger, next to <ledger>.bc
+ledger_index_suffix="_dedup.pickle"
+ledger_index_version=4
+
+# saved ledger indexes get a Bloom filter of their fingerprints, so entries
+# that are definitely new skip loading and searching the buckets
+use_bloom=True
+# false positive rate of the Bloom filter at its capacity
+bloom_error_rate=0.01
+# capacity of a new filter, as a multiple of the number of fingerprints 
+# (room for stage --update to add entries before it is resized)
+bloom_headroom=2
+
+# PostingIndex: transactions up to this many days apart can be duplicates
+posting_days=0
+
+def index_keys(e):
+	""" Keys under which an entry is stored in a DedupIndex
+		Returns: list of (key, amount number or None)
+	"""
+	keys=[]
+	name=type(e).__name__
+	if type(e)==Transaction:
+		# the last posting to each account is the one compared
+		units_by_account={}
+		for p in e.postings:
+			units_by_account[p.account]=p.units
+		for account,units in units_by_account.items():
+			if units:
+				keys.append(((name,e.date,account,units.currency),units.number))
+	elif type(e)==Balance or type(e)==Open:
+		keys.append(((name,e.date,e.account),None))
+	elif type(e)==Commodity or type(e)==Price:
+		keys.append(((name,e.date,e.currency),None))
+	elif type(e)==Event:
+		keys.append(((name,e.date,e.type,e.description),None))
+	return(keys)
+
+def lookup_key(e):
+	""" Key to look up duplicates of an entry in a DedupIndex
+		Returns: (key, amount number or None) or (None, None)
+	"""
+	if type(e)==Transaction:
+		if len(e.postings) > 0 and e.postings[0].units:
+			units=e.postings[0].units
+			return((type(e).__name__,e.date,e.postings[0].account,units.currency),units.number)
+		return(None,None)
+	keys=index_keys(e)
+	if len(keys) > 0:
+		return(keys[0])
+	return(None,None)
+
+def cents(number):
+	return(int((number*100).to_integral_value(rounding=ROUND_FLOOR)))
+
+def bloom_items(e):
+	""" Fingerprints of an entry stored in a Bloom filter
+		Returns: list of (key, amount in whole cents or None)
+	"""
+	return([(key,None if number==None else cents(number)) for key,number in index_keys(e)])
+
+def bloom_probes(e):
+	""" Fingerprints to look for in a Bloom filter, one for each whole cent 
+		amount within compare_delta of the first posting
+		Returns: list of (key, amount in whole cents or None)
+	"""
+	key,number=lookup_key(e)
+	if key==None:
+		return([])
+	if number==None:
+		return([(key,None)])
+	return([(key,c) for c in range(cents(number-compare_delta),cents(number+compare_delta)+1)])
+
+class BloomFilter:
+	""" Bloom filter of entry fingerprints
+
+		Arguments:
+			capacity: number of fingerprints before the false positive 
+				rate goes above error_rate
+			error_rate: false positive rate at capacity
+
+		Notes:
+			Fingerprints are hashed with blake2b (not hash(), which 
+			changes between runs) so a filter can be saved with the index
+	"""
+	def __init__(self,capacity,error_rate=None):
+		if error_rate==None:
+			error_rate=bloom_error_rate
+		self.capacity=max(int(capacity),1)
+		self.n_bits=max(int(math.ceil(-self.capacity*math.log(error_rate)/math.log(2)**2)),8)
+		self.n_hashes=max(int(round(self.n_bits/self.capacity*math.log(2))),1)
+		self.bits=bytearray((self.n_bits+7)//8)
+		self.count=0
+
+	def positions(self,item):
+		h=hashlib.blake2b(repr(item).encode(),digest_size=16).digest()
+		h1=int.from_bytes(h[:8],'little')
+		h2=int.from_bytes(h[8:],'little')|1
+		return([(h1+i*h2)%self.n_bits for i in range(self.n_hashes)])
+
+	def add(self,item):
+		for b in self.positions(item):
+			self.bits[b>>3]|=1<<(b&7)
+		self.count+=1
+		return
+
+	def __contains__(self,item):
+		for b in self.positions(item):
+			if not self.bits[b>>3]&(1<<(b&7)):
+				return(False)
+		return(True)
+
+	def fill_ratio(self):
+		return(sum([bin(x).count('1') for x in self.bits])/self.n_bits)
+
+class DedupIndex:
+	""" Hash index of entries by (type, date, account/currency) to find
+		duplicates of other entries in O(1) expected time
+
+		Arguments:
+			entries: list of entries to index (optional)
+
+		Notes:
+			Each bucket keeps entries in the order they were added, so
+			duplicates come back in the same order as a scan of the list
+			A saved ledger index (see get_ledger_index) only keeps the
+			fingerprints (keys) of the entries, which are returned as the
+			duplicates instead of the entries themselves
+			A saved ledger index also has a Bloom filter (if use_bloom)
+			that is checked first; its buckets are only unpickled when 
+			an entry might be a duplicate. The hits, misses and 
+			false_positives counters are for sizing the filter.
+			It also counts the ledger's (payee, account) pairs in history,
+			for account suggestions (see suggest.py).
+	"""
+	def __init__(self,entries=None):
+		self._buckets={}
+		self.packed=None # pickled buckets, unpickled on first use
+		self.opened=None # open accounts of packed buckets
+		self.files={} # signature by filename, for a saved ledger index
+		self.ledger_hash=None # sha256 of the ledger, for a saved ledger index
+		self.plugins=[] # plugins used by the ledger
+		self.history=Counter() # (payee, account) of a saved ledger index
+		self.bloom=None
+		self.hits=0 # entries the Bloom filter passed on
+		self.misses=0 # entries the Bloom filter rejected (definitely new)
+		self.false_positives=0 # hits without a duplicate
+		if entries:
+			self.add_entries(entries)
+
+	@property
+	def buckets(self):
+		if self.packed!=None:
+			self._buckets=pickle.loads(self.packed)
+			self.packed=None
+			self.opened=None
+		return(self._buckets)
+
+	def new_bloom(self,capacity=None):
+		""" Replaces the Bloom filter with one holding all fingerprints
+		"""
+		n_items=sum([len(v) for v in self.buckets.values()])
+		if capacity==None:
+			capacity=bloom_headroom*n_items
+		self.bloom=BloomFilter(capacity)
+		for key,v in self.buckets.items():
+			for number,_ in v:
+				self.bloom.add((key,None if number==None else cents(number)))
+		return
+
+	def add(self,e,fingerprint=False,tag=None):
+		""" Adds an entry, or only its fingerprints if fingerprint is True
+			Arguments: tag = if not None, (tag, entry) is stored instead of
+				the entry, e.g. to tell which list it came from
+		"""
+		if self.bloom!=None:
+			for item in bloom_items(e):
+				self.bloom.add(item)
+		buckets=self.buckets
+		for key,number in index_keys(e):
+			item=e
+			if fingerprint:
+				item=key
+			if tag!=None:
+				item=(tag,item)
+			if key in buckets:
+				buckets[key].append((number,item))
+			else:
+				buckets[key]=[(number,item)]
+		return
+
+	def add_entries(self,entries,fingerprint=False,tag=None):
+		for e in entries:
+			self.add(e,fingerprint,tag)
+		return
+
+	def duplicates(self,e):
+		""" Returns: list of indexed entries (or fingerprints) that 
+			duplicate e
+		"""
+		if self.bloom!=None:
+			if not any([item in self.bloom for item in bloom_probes(e)]):
+				self.misses+=1
+				return([])
+			self.hits+=1
+		dups=[]
+		key,number=lookup_key(e)
+		if key!=None and key in self.buckets:
+			if number==None:
+				dups=[ne for _,ne in self.buckets[key]]
+			else:
+				dups=[ne for n,ne in self.buckets[key] if abs(n-number) < compare_delta]
+		if self.bloom!=None and len(dups)==0:
+			self.false_positives+=1
+		return(dups)
+
+	def open_accounts(self):
+		""" Returns: list of accounts with an Open entry
+		"""
+		if self.packed!=None and self.opened!=None:
+			return(list(self.opened))
+		return([key[2] for key in self.buckets if key[0]=="Open"])
+
+	def bloom_stats(self):
+		""" Returns: string with Bloom filter size and hit/miss rates
+		"""
+		if self.bloom==None:
+			return("no Bloom filter")
+		n=self.hits+self.misses
+		return("{0} fingerprints in {1} kB ({2} hashes, {3:.1%} full): {4} lookups, {5:.1%} hit, {6:.1%} miss, {7} false positives".format(
+			self.bloom.count,
+			len(self.bloom.bits)//1024,
+			self.bloom.n_hashes,
+			self.bloom.fill_ratio(),
+			n,
+			self.hits/max(n,1),
+			self.misses/max(n,1),
+			self.false_positives,
+		))
+
+def posting_fingerprint(e):
+	""" Postings of a transaction as a sorted list of 
+		(account, currency, number), currency and number are None for
+		postings without units (e.g. to be interpolated)
+	"""
+	fp=[]
+	for p in e.postings:
+		if p.units and isinstance(p.units,Amount) and isinstance(p.units.number,Decimal):
+			fp.append((p.account,p.units.currency,p.units.number))
+		else:
+			fp.append((p.account,None,None))
+	fp.sort(key=lambda x: (x[0],x[1] or ""))
+	return(fp)
+
+def postings_match(a,b):
+	""" True if two posting fingerprints have the same account, and the
+		same currency and amount (within compare_delta) if both have units
+	"""
+	if a[0]!=b[0]:
+		return(False)
+	if a[2]!=None and b[2]!=None:
+		return(a[1]==b[1] and abs(a[2]-b[2]) < compare_delta)
+	return(True)
+
+def same_postings(fp_a,fp_b):
+	""" True if each posting in fp_a matches a different posting of fp_b
+		Notes: postings match if they have the same account, and the same
+			currency and amount (within compare_delta) if both have units.
+			Pairs are found with augmenting paths (bipartite matching), so
+			a posting without units can't take the only match of one 
+			with units
+	"""
+	if len(fp_a) > len(fp_b):
+		return(False)
+	candidates=[[j for j,b in enumerate(fp_b) if postings_match(a,b)] for a in fp_a]
+	matched_to=[None]*len(fp_b) # index in fp_a of each fp_b posting
+	def augment(i,seen):
+		for j in candidates[i]:
+			if j in seen:
+				continue
+			seen.add(j)
+			if matched_to[j]==None or augment(matched_to[j],seen):
+				matched_to[j]=i
+				return(True)
+		return(False)
+	for i in range(len(fp_a)):
+		if not augment(i,set()):
+			return(False)
+	return(True)
+
+class PostingIndex:
+	""" Transactions kept in date sorted arrays to find duplicates by 
+		comparing all of their postings
+
+		Arguments:
+			entries: list of entries to index
+			tags: optional list of tags, one for each entry, to return 
+				(tag, entry) pairs as duplicates like DedupIndex.add
+
+		Notes:
+			Two cash transactions of the same amount on the same day (e.g.
+			$10 of X and $10 of Y) are not duplicates as long as they were
+			assigned to different accounts.
+			The candidates for an entry are the transactions within 
+			posting_days of its date, found with numpy.searchsorted, so
+			finding the duplicates of M entries in N is O(M log N).
+			An extracted transaction is a duplicate of a ledger one if 
+			each of its postings matches one of the ledger postings, so 
+			a ledger transaction that was split further still matches.
+			A ledger transaction re-assigned to another account by hand
+			no longer matches, unlike with DedupIndex.
+			Other entries are compared the same way as in DedupIndex.
+	"""
+	def __init__(self,entries,tags=None):
+		if tags==None:
+			items=[(e,e) for e in entries]
+		else:
+			items=[(e,(t,e)) for e,t in zip(entries,tags)]
+		transactions=[(e,item) for e,item in items if type(e)==Transaction]
+		# stable sort, so entries with the same date keep their order
+		transactions.sort(key=lambda x: x[0].date)
+		self.entries=[item for _,item in transactions]
+		self.dates=np.array([e.date.toordinal() for e,_ in transactions],dtype=np.int64)
+		self.fingerprints=[posting_fingerprint(e) for e,_ in transactions]
+		self.others=DedupIndex()
+		for e,t in zip(entries,tags or [None]*len(entries)):
+			if type(e)!=Transaction:
+				self.others.add(e,tag=t)
+
+	def duplicates(self,e):
+		""" Returns: list of indexed entries that duplicate e
+		"""
+		if type(e)!=Transaction:
+			return(self.others.duplicates(e))
+		day=e.date.toordinal()
+		lo=np.searchsorted(self.dates,day-posting_days,side='left')
+		hi=np.searchsorted(self.dates,day+posting_days,side='right')
+		fp=posting_fingerprint(e)
+		return([self.entries[i] for i in range(lo,hi) if same_postings(fp,self.fingerprints[i])])
+
+def ledger_index_file(ledger_file):
+	return(os.path.splitext(ledger_file)[0]+ledger_index_suffix)
+
+def save_ledger_index(ledger_file,index):
+	""" Saves fingerprints of index next to the ledger file
+	"""
+	if use_bloom and (index.bloom==None or index.bloom.count > index.bloom.capacity):
+		index.new_bloom()
+	saved={
+		'files':index.files,
+		'ledger_hash':index.ledger_hash,
+		'plugins':index.plugins,
+		'open':index.open_accounts(),
+		'history':index.history,
+		'bloom':index.bloom,
+		# pickled separately so loading the index doesn't unpickle them
+		'buckets':pickle.dumps({k:[(n,k) for n,_ in v] for k,v in index.buckets.items()}),
+	}
+	save_pickle(ledger_index_file(ledger_file),ledger_index_version,saved,"ledger index")
+	return
+
+def load_ledger_index(ledger_file,check_files=True):
+	""" Loads the saved fingerprint index of a ledger
+		Arguments:
+			ledger_file: path of ledger (.bc) file
+			check_files: only return the index if none of the ledger 
+				files (including included files) changed since it was saved
+		Returns: DedupIndex or None
+	"""
+	saved=load_pickle(ledger_index_file(ledger_file),ledger_index_version,"ledger index")
+	if saved==None:
+		return(None)
+	if check_files:
+		for filename,signature in saved['files'].items():
+			if not os.path.isfile(filename) or file_signature(filename)!=signature:
+				return(None)
+	index=DedupIndex()
+	index.files=saved['files']
+	index.ledger_hash=saved['ledger_hash']
+	index.plugins=saved['plugins']
+	index.opened=saved['open']
+	index.history=saved['history']
+	index.packed=saved['buckets']
+	if use_bloom:
+		index.bloom=saved['bloom']
+	return(index)
+
+def build_ledger_index(ledger_file):
+	""" Loads the ledger and saves its fingerprint index
+		Returns: DedupIndex
+	"""
+	entries, errors, options_map = loader.load_file(ledger_file)
+	index=DedupIndex()
+	index.add_entries(entries,fingerprint=True)
+	index.history=narration_accounts(entries)
+	index.files={f:file_signature(f) for f in options_map['include'] if os.path.isfile(f)}
+	index.ledger_hash=file_hash(ledger_file)
+	index.plugins=[p for p,_ in options_map['plugin']]
+	save_ledger_index(ledger_file,index)
+	return(index)
+
+def get_ledger_index(ledger_file):
+	""" Returns the fingerprint index of a ledger, only loading the 
+		ledger itself if the saved index is missing or out of date
+	"""
+	index=load_ledger_index(ledger_file)
+	if index==None:
+		index=build_ledger_index(ledger_file)
+	return(index)
+
+def complete_entries(entries):
+	""" True if every posting has explicit units, i.e. parsed entries
+		have the same fingerprints as loaded (interpolated) entries
+	"""
+	for e in entries:
+		if type(e)==Transaction:
+			for p in e.postings:
+				if type(p.units)!=Amount or not isinstance(p.units.number,Decimal):
+					return(False)
+	return(True)
+
+def update_ledger_index(ledger_file,new_entries_file):
+	""" Updates the saved index after ledger_file was replaced by the old 
+		ledger with new_entries_file appended (as stage --update does)
+		Returns: DedupIndex
+		Notes:
+			Only the new entries are parsed. If the ledger wasn't simply 
+			appended to (its size or the hash of the indexed part differ), or plugins could add entries (e.g. auto), the 
+			ledger is loaded and the index rebuilt instead.
+	"""
+	index=load_ledger_index(ledger_file,check_files=False)
+	abs_ledger=os.path.abspath(ledger_file)
+	if index==None or len(index.plugins) > 0 or not abs_ledger in index.files or not os.path.isfile(new_entries_file):
+		return(build_ledger_index(ledger_file))
+	# every other file must be unchanged
+	for filename,signature in index.files.items():
+		if filename!=abs_ledger and (not os.path.isfile(filename) or file_signature(filename)!=signature):
+			return(build_ledger_index(ledger_file))
+	# the ledger must be the indexed ledger, unchanged, with the new entries
+	old_size=index.files[abs_ledger][1]
+	if file_signature(ledger_file)[1]!=old_size+os.path.getsize(new_entries_file) or file_hash(ledger_file,old_size)!=index.ledger_hash:
+		return(build_ledger_index(ledger_file))
+	entries, errors, options_map = parser.parse_file(new_entries_file)
+	if len(errors) > 0 or len(options_map['include']) > 0 or len(options_map['plugin']) > 0 or not complete_entries(entries):
+		return(build_ledger_index(ledger_file))
+	index.add_entries(entries,fingerprint=True)
+	index.history.update(narration_accounts(entries))
+	index.files[abs_ledger]=file_signature(ledger_file)
+	index.ledger_hash=file_hash(ledger_file)
+	save_ledger_index(ledger_file,index)
+	return(index)
@@ -0,0 +1,496 @@
+# Compiled rule matching for yaml account assignment files
+#
+# A yaml assignment file is an ordered dict of regex pattern: account.
+# The first pattern (in file order) that matches an entry wins, unless a
+# more specific pattern that it subsumes (see assign.group_regex) matches
+# a longer span of the payee string.
+
+import re
+import time
+from collections import OrderedDict
+
+# number of consecutive rules folded into one combined alternation regex
+rules_per_block=64
+
+# route literal rules (most of what assign.regexify makes) to a hash/trie
+# instead of the re module - set to False to use regex for every rule
+literal_rules=True
+
+# number of (payee, category):pattern results remembered by a RuleMatcher,
+# 0 turns the memo off
+memo_size=10000
+
+# length of the substrings SubsumptionIndex indexes patterns by
+gram_size=3
+
+# flags of a plain pattern without inline flags, e.g. re.compile("Foo")
+default_flags=re.compile("").flags
+
+# characters that make a pattern more than a literal
+regex_chars=set(".^$*+?{}[]\\|()")
+digit_count=re.compile("\\{([0-9]+)\\}")
+
+# steps of a literal rule besides single characters
+ANY=0 # '.'
+DIGIT=1 # '[0-9]'
+
+# group references, which would point elsewhere once groups are renumbered
+group_reference=re.compile("\\\\[1-9]|\\(\\?P=|\\(\\?\\(")
+
+def combinable(compiled):
+	""" True if a compiled pattern can be folded into an alternation
+		without changing what it matches
+		Notes: capture groups are renumbered in the alternation, which
+			breaks backreferences, and inline flags like (?i) would apply
+			to all the other patterns
+	"""
+	if compiled.flags!=default_flags:
+		return(False)
+	return(compiled.groups==0 or not group_reference.search(compiled.pattern))
+
+def classify(pattern):
+	""" Classifies a pattern as a literal rule or a true regex
+		Args: pattern = regex string from yaml file
+		Returns: (steps, anchored_start, anchored_end) for a literal rule,
+			where steps is a list of characters, ANY or DIGIT,
+			or None if the pattern needs the re module
+		Notes: literal rules are plain text with optional '.' and
+			'[0-9]{n}' parts, optionally anchored with '^' and/or '$',
+			which is what regexify generates
+	"""
+	if type(pattern)!=str:
+		return(None)
+	body=pattern
+	anchored_start=body.startswith('^')
+	if anchored_start:
+		body=body[1:]
+	anchored_end=body.endswith('$')
+	if anchored_end:
+		body=body[:-1]
+	steps=[]
+	i=0
+	while i < len(body):
+		c=body[i]
+		if c=='.':
+			steps.append(ANY)
+			i+=1
+		elif body.startswith('[0-9]',i):
+			i+=5
+			n=1
+			m=digit_count.match(body,i)
+			if m:
+				n=int(m.group(1))
+				i=m.end()
+			if n==0:
+				return(None)
+			steps.extend([DIGIT]*n)
+		elif c in regex_chars:
+			return(None)
+		else:
+			steps.append(c)
+			i+=1
+	if len(steps)==0:
+		return(None)
+	return(steps,anchored_start,anchored_end)
+
+def new_node():
+	# [children by character, ANY child, DIGIT child, [(rule index, anchored_end)]]
+	return([{},None,None,[]])
+
+def add_to_trie(root,steps,idx,anchored_end):
+	node=root
+	for step in steps:
+		if step==ANY:
+			if node[1]==None:
+				node[1]=new_node()
+			node=node[1]
+		elif step==DIGIT:
+			if node[2]==None:
+				node[2]=new_node()
+			node=node[2]
+		else:
+			if not step in node[0]:
+				node[0][step]=new_node()
+			node=node[0][step]
+	node[3].append((idx,anchored_end))
+	return
+
+class RuleMatcher:
+	""" All assignment rules for one account compiled into one object
+
+		Arguments:
+			assignLUT: dict of pattern:account, in yaml file order
+			assign_groups: dict of pattern:[patterns subsumed by pattern]
+				as returned by assign.group_regex
+			memo: optional dict of (payee, category):pattern from an 
+				earlier run with the same rules (see assign.load_memo)
+			compiled: optional dict of pattern:compiled regex, e.g. from
+				rulestore.rule_store
+
+		Notes:
+			Literal rules (see classify) never go through the re module:
+			rules like '^ABC$' are looked up in a hash of exact strings,
+			and the rest are walked in a prefix trie from each position
+			of the payee string, so their cost doesn't grow with the
+			number of rules.
+			The remaining (true regex) rules are compiled once and folded
+			into blocks of up to rules_per_block patterns joined into one
+			alternation regex. A block regex finds a match iff one of its
+			patterns does, so a single scan of the payee string over all
+			blocks skips every rule that can't match; only rules in a
+			matching block are searched one by one.
+			Results of match are kept in an LRU memo of up to memo_size
+			payees, as downloads repeat the same payees many times.
+	"""
+	def __init__(self,assignLUT,assign_groups,memo=None,compiled=None):
+		self.memo=OrderedDict(memo or {})
+		self.memo_changed=False
+		self.memo_hits=0
+		self.memo_misses=0
+		self.patterns=list(assignLUT)
+		self.alts=[assign_groups.get(p,[]) for p in self.patterns]
+		self.compiled=dict(compiled or {})
+		self.lengths={} # span of a match, by literal rule index
+		self.exact={} # string:rule index for '^literal$' rules
+		self.anchored=new_node() # trie of '^literal' rules
+		self.unanchored=new_node() # trie of all other literal rules
+		self.blocks=[] # list of ([rule index], combined regex or None)
+		self.n_literal=0
+		block=[]
+		for i,p in enumerate(self.patterns):
+			literal=None
+			if literal_rules:
+				literal=classify(p)
+			if literal:
+				steps,anchored_start,anchored_end=literal
+				self.lengths[i]=len(steps)
+				self.n_literal+=1
+				if anchored_start and anchored_end and not ANY in steps and not DIGIT in steps:
+					self.exact.setdefault(''.join(steps),i)
+				elif anchored_start:
+					add_to_trie(self.anchored,steps,i,anchored_end)
+				else:
+					add_to_trie(self.unanchored,steps,i,anchored_end)
+				continue
+			c=self.compiled_pattern(p)
+			if not combinable(c):
+				self.add_block(block)
+				self.blocks.append(([i],None))
+				block=[]
+			else:
+				block.append(i)
+				if len(block)==rules_per_block:
+					self.add_block(block)
+					block=[]
+		self.add_block(block)
+		# alternatives of each rule split by kind, or None if an
+		# alternative isn't one of the rules
+		position={p:i for i,p in enumerate(self.patterns)}
+		self.alt_index=[]
+		for alts in self.alts:
+			if all([a in position for a in alts]):
+				alt_idx=[position[a] for a in alts]
+				self.alt_index.append((set([i for i in alt_idx if i in self.lengths]),[i for i in alt_idx if not i in self.lengths]))
+			else:
+				self.alt_index.append(None)
+
+	def compiled_pattern(self,p):
+		if not p in self.compiled:
+			self.compiled[p]=re.compile(p)
+		return(self.compiled[p])
+
+	def add_block(self,block):
+		if len(block)==0:
+			return
+		combined=None
+		if len(block) > 1:
+			try:
+				combined=re.compile("|".join(["(?:"+self.patterns[i]+")" for i in block]))
+			except re.error:
+				combined=None
+		self.blocks.append((block,combined))
+		return
+
+	def regex_first(self,s,stop=None):
+		""" Finds the first true regex rule in file order that matches s
+			Args: s = string to search, stop = only try rules before this
+			Returns: (rule index, re.Match) or (None, None)
+		"""
+		for block,combined in self.blocks:
+			if stop!=None and block[0]>=stop:
+				break
+			if combined and not combined.search(s):
+				continue
+			for i in block:
+				if stop!=None and i>=stop:
+					break
+				sr=self.search(i,s)
+				if sr:
+					return(i,sr)
+		return(None,None)
+
+	def search(self,i,s):
+		""" Searches s with true regex rule i
+			Returns: re.Match or None
+		"""
+		return(self.compiled[self.patterns[i]].search(s))
+
+	def literal_matches(self,s):
+		""" Finds all literal rules that match s
+			Returns: set of rule indices
+		"""
+		matched=set()
+		n=len(s)
+		if s in self.exact:
+			matched.add(self.exact[s])
+		# '$' also matches before a trailing newline
+		if n > 0 and s[-1]=='\n' and s[:-1] in self.exact:
+			matched.add(self.exact[s[:-1]])
+		for root,starts in ((self.anchored,range(min(n,1))),(self.unanchored,range(n))):
+			for i in starts:
+				states=[root]
+				j=i
+				while len(states) > 0 and j < n:
+					c=s[j]
+					next_states=[]
+					for node in states:
+						child=node[0].get(c)
+						if child:
+							next_states.append(child)
+						if node[1] and c!='\n':
+							next_states.append(node[1])
+						if node[2] and '0'<=c<='9':
+							next_states.append(node[2])
+					j+=1
+					for node in next_states:
+						for idx,anchored_end in node[3]:
+							if not anchored_end or j==n or (j==n-1 and s[j]=='\n'):
+								matched.add(idx)
+					states=next_states
+		return(matched)
+
+	def first_match(self,s,stop=None,literal=None):
+		""" Finds the first rule in file order that matches s
+			Args: s = string to search, stop = only try rules before this
+				literal = literal_matches(s) if already known
+			Returns: (rule index, length of matched span) or (None, None)
+		"""
+		if literal==None:
+			literal=self.literal_matches(s)
+		idx=None
+		if len(literal) > 0:
+			idx=min(literal)
+			if stop!=None and idx>=stop:
+				idx=None
+		# a regex rule only wins if it comes before the literal one
+		ridx,sr=self.regex_first(s,stop=idx if idx!=None else stop)
+		if ridx!=None:
+			return(ridx,sr.end()-sr.start())
+		if idx!=None:
+			return(idx,self.lengths[idx])
+		return(None,None)
+
+	def match(self,id_str,category=None):
+		""" Finds best matching pattern, same as assign.best_match over
+			all rules in file order
+			Args: id_str = payee part of narration, category = optional
+				category from metadata, tried if the payee doesn't match
+			Returns: pattern which is key to assign dict
+				An empty string if no match is found
+		"""
+		key=(id_str,category)
+		if key in self.memo:
+			self.memo.move_to_end(key)
+			self.memo_hits+=1
+			return(self.memo[key])
+		self.memo_misses+=1
+		_,best_pattern=self.resolve(id_str,category)
+		if memo_size > 0:
+			self.memo[key]=best_pattern
+			self.memo_changed=True
+			if len(self.memo) > memo_size:
+				self.memo.popitem(last=False)
+		return(best_pattern)
+
+	def find_match(self,id_str,category=None):
+		""" match without the memo
+		"""
+		return(self.resolve(id_str,category)[1])
+
+	def resolve(self,id_str,category=None):
+		""" Finds the first matching rule and the best pattern
+			Returns: (index of first matching rule or None, best pattern)
+				the best pattern is "" if no rule matches, and differs from
+				the first rule if a longer alternative wins
+		"""
+		literal=self.literal_matches(id_str)
+		idx,max_span=self.first_match(id_str,literal=literal)
+		if category!=None:
+			# an earlier rule can still match on the category
+			cidx,cspan=self.first_match(category,stop=idx)
+			if cidx!=None:
+				idx,max_span=cidx,cspan
+		if idx==None:
+			return(None,"")
+		best_pattern=self.patterns[idx]
+		# a longer match on a more specific pattern wins (the first one
+		# in file order if several are equally long)
+		if self.alt_index[idx]==None:
+			for alt_p in self.alts[idx]:
+				r=self.compiled_pattern(alt_p).search(id_str)
+				if r and r.end()-r.start() > max_span:
+					best_pattern=alt_p
+					max_span=r.end()-r.start()
+			return(idx,best_pattern)
+		alt_literal,alt_regex=self.alt_index[idx]
+		spans=[(i,self.lengths[i]) for i in literal if i in alt_literal]
+		for i in alt_regex:
+			r=self.search(i,id_str)
+			if r:
+				spans.append((i,r.end()-r.start()))
+		for i,span in sorted(spans):
+			if span > max_span:
+				best_pattern=self.patterns[i]
+				max_span=span
+		return(idx,best_pattern)
+
+class RuleProfiler(RuleMatcher):
+	""" RuleMatcher that records how often each rule matches and how long
+		its regex searches take (see assign.profile_rules)
+
+		Notes:
+			The memo is not used and regex rules are searched one at a 
+			time instead of in combined blocks, so every match is counted
+			and each rule's time is its own. Literal rules are matched 
+			together in the trie, so only their total time is known.
+	"""
+	# columns of stats
+	columns=["hits","first_matches","override_wins","overridden","searches","seconds"]
+
+	def __init__(self,assignLUT,assign_groups,memo=None,compiled=None):
+		RuleMatcher.__init__(self,assignLUT,assign_groups,compiled=compiled)
+		self.blocks=[(block,None) for block,_ in self.blocks]
+		self.stats=OrderedDict([(p,[0,0,0,0,0,0.0]) for p in self.patterns])
+		self.literal_searches=0
+		self.literal_seconds=0.0
+
+	def search(self,i,s):
+		t0=time.perf_counter()
+		sr=RuleMatcher.search(self,i,s)
+		st=self.stats[self.patterns[i]]
+		st[4]+=1
+		st[5]+=time.perf_counter()-t0
+		return(sr)
+
+	def literal_matches(self,s):
+		t0=time.perf_counter()
+		matched=RuleMatcher.literal_matches(self,s)
+		self.literal_searches+=1
+		self.literal_seconds+=time.perf_counter()-t0
+		return(matched)
+
+	def match(self,id_str,category=None):
+		idx,best_pattern=self.resolve(id_str,category)
+		if idx!=None:
+			first=self.patterns[idx]
+			self.stats[first][1]+=1
+			self.stats.setdefault(best_pattern,[0,0,0,0,0,0.0])[0]+=1
+			if best_pattern!=first:
+				self.stats[first][3]+=1
+				self.stats[best_pattern][2]+=1
+		return(best_pattern)
+
+def required_literal(pattern):
+	""" Longest plain text that every string matched by pattern contains
+		Returns: string, or None if not known (pattern isn't a literal rule)
+	"""
+	literal=classify(pattern)
+	if literal==None:
+		return(None)
+	best=""
+	run=""
+	for step in literal[0]+[ANY]:
+		if step==ANY or step==DIGIT:
+			if len(run) > len(best):
+				best=run
+			run=""
+		else:
+			run+=step
+	return(best)
+
+class SubsumptionIndex:
+	""" Finds which of a list of patterns a pattern matches when they are
+		searched as strings, i.e. re.search(p1,p2) for every p2, without 
+		searching every p2
+
+		Arguments:
+			patterns: list of regex pattern strings
+
+		Notes:
+			Each pattern is indexed by its substrings of gram_size
+			characters. A literal rule p1 (see classify) can only match 
+			patterns that contain its longest plain text part, so only 
+			patterns that have all of that text's substrings are searched.
+			True regex rules are searched against every pattern.
+	"""
+	def __init__(self,patterns):
+		self.patterns=list(patterns)
+		self.grams={}
+		for j,p in enumerate(self.patterns):
+			for g in set([p[k:k+gram_size] for k in range(len(p)-gram_size+1)]):
+				if g in self.grams:
+					self.grams[g].append(j)
+				else:
+					self.grams[g]=[j]
+
+	def candidates(self,p1):
+		""" Returns: indices of patterns p1 might match, in list order
+		"""
+		text=required_literal(p1)
+		if text==None or len(text)==0:
+			return(range(len(self.patterns)))
+		if len(text) < gram_size:
+			return([j for j,p2 in enumerate(self.patterns) if text in p2])
+		postings=sorted([self.grams.get(text[k:k+gram_size],[]) for k in range(len(text)-gram_size+1)],key=len)
+		found=set(postings[0])
+		# the rarest few substrings are enough to prune, the text check
+		# below is exact
+		for posting in postings[1:3]:
+			found.intersection_update(posting)
+		return([j for j in sorted(found) if text in self.patterns[j]])
+
+	def subsumed(self,p1):
+		""" Returns: patterns other than p1 that p1 matches, in list order
+		"""
+		c=re.compile(p1)
+		return([self.patterns[j] for j in self.candidates(p1) if self.patterns[j]!=p1 and c.search(self.patterns[j])])
+
+def redundant_patterns(entries):
+	""" Finds rules that a simpler rule assigning the same account matches
+		(yaml_util --similar)
+		Args: entries = dict of pattern:account
+		Returns: (dict of redundant pattern:True, number of 
+			(simpler, redundant) pattern pairs)
+		Notes: 
+			Only patterns of the same account can make each other 
+			redundant, so each account's patterns are compared on their
+			own, with a SubsumptionIndex
+	"""
+	if len(entries) > 1:
+		# a bad pattern fails the same way as comparing all pairs
+		[re.compile(p) for p in entries]
+	by_account=OrderedDict()
+	for p,account in entries.items():
+		if account in by_account:
+			by_account[account].append(p)
+		else:
+			by_account[account]=[p]
+	remove_pattern={}
+	removed=0
+	for account,patterns in by_account.items():
+		index=SubsumptionIndex(patterns)
+		for p1 in patterns:
+			for p2 in index.subsumed(p1):
+				remove_pattern[p2]=True
+				removed+=1
+	return(remove_pattern,removed)
@@ -0,0 +1,133 @@
+# Shared loader for yaml rule files
+#
+# Account assignment (<Account>.yaml), check payee (<Account>_payees.yaml)
+# and unassigned yaml files are all dicts of pattern (or check number): value.
+# rule_store loads each file once per process, and also keeps the parsed
+# dict pickled next to the file so other processes (e.g. yaml_util run by
+# stage, assign workers) don't have to parse it again.
+
+import os, sys
+import re
+import yaml
+
+from beanjmw.importers.filters.cachefile import file_signature, load_pickle, save_pickle
+
+# keep parsed yaml files pickled next to them with this suffix
+disk_cache=True
+cache_suffix="_yaml.pickle"
+cache_version=1
+
+def validate(filename,data):
+	""" Checks a loaded rule file
+		Returns: data, or an empty dict for an empty file
+		Notes: raises ValueError if it isn't a dict of str or int keys
+	"""
+	if data==None:
+		return({})
+	if not isinstance(data,dict):
+		raise ValueError("{0}: expected pattern: value lines, not {1}".format(filename,type(data).__name__))
+	for k in data:
+		if not type(k) in (str,int):
+			raise ValueError("{0}: bad key {1!r}, expected a pattern or check number".format(filename,k))
+	return(data)
+
+class RuleStore:
+	""" Loads yaml rule files once and keeps them, and their compiled
+		patterns, until the file changes
+
+		Arguments:
+			disk_cache: also pickle parsed files next to them, None for
+				the module setting
+
+		Notes:
+			Files are keyed by mtime and size. The dicts returned by load
+			are shared, so copy one before changing it.
+	"""
+	def __init__(self,disk_cache=None):
+		self.disk_cache=disk_cache
+		self.files={} # filename:(signature,data)
+		self.patterns={} # filename:(signature,{pattern:compiled})
+		self.payees={} # filename:(signature,{check number:payee})
+		self.loads=0 # number of times a file was actually parsed
+
+	def use_disk_cache(self,filename):
+		# unassigned files are removed by stage --clean, don't leave 
+		# caches of them behind
+		if "_unassigned" in os.path.basename(filename):
+			return(False)
+		if self.disk_cache==None:
+			return(disk_cache)
+		return(self.disk_cache)
+
+	def cache_file(self,filename):
+		return(os.path.splitext(filename)[0]+cache_suffix)
+
+	def load_cached(self,filename,signature):
+		cache=load_pickle(self.cache_file(filename),cache_version,"yaml cache")
+		if cache and cache['signature']==signature:
+			return(cache['data'])
+		return(None)
+
+	def save_cached(self,filename,signature,data):
+		save_pickle(self.cache_file(filename),cache_version,{'signature':signature,'data':data},"yaml cache")
+		return
+
+	def load(self,filename):
+		""" Returns: dict of pattern (or check number):value in file order
+		"""
+		signature=file_signature(filename)
+		if filename in self.files and self.files[filename][0]==signature:
+			return(self.files[filename][1])
+		data=None
+		if self.use_disk_cache(filename):
+			data=self.load_cached(filename,signature)
+		if data==None:
+			with open(filename,'r') as f:
+				data=validate(filename,yaml.safe_load(f))
+			self.loads+=1
+			if self.use_disk_cache(filename):
+				self.save_cached(filename,signature,data)
+		self.files[filename]=(signature,data)
+		return(data)
+
+	def compiled(self,filename):
+		""" Returns: dict of pattern:compiled regex for the str keys of the
+			file
+		"""
+		data=self.load(filename)
+		signature=self.files[filename][0]
+		if filename in self.patterns and self.patterns[filename][0]==signature:
+			return(self.patterns[filename][1])
+		patterns={}
+		for p in data:
+			if type(p)==str:
+				try:
+					patterns[p]=re.compile(p)
+				except re.error as ex:
+					sys.stderr.write("Error: bad pattern {0!r} in {1}: {2}\n".format(p,filename,ex))
+					raise
+		self.patterns[filename]=(signature,patterns)
+		return(patterns)
+
+	def check_payees(self,filename):
+		""" Returns: dict of check number:payee for the int keys of a 
+			<Account>_payees.yaml file
+		"""
+		data=self.load(filename)
+		signature=self.files[filename][0]
+		if filename in self.payees and self.payees[filename][0]==signature:
+			return(self.payees[filename][1])
+		payees={k:v for k,v in data.items() if type(k)==int}
+		self.payees[filename]=(signature,payees)
+		return(payees)
+
+	def forget(self,filename):
+		""" Drops a file from memory, e.g. after rewriting it
+		"""
+		self.files.pop(filename,None)
+		self.patterns.pop(filename,None)
+		self.payees.pop(filename,None)
+		return
+
+# shared by everything that reads rule files
+rule_store=RuleStore()
@@ -0,0 +1,49 @@
+# Pre-screen of extracted entries before account assignment
+#
+# One pass over the entries of a file flags, for each entry:
+#	zero: transactions with one posting of zero units (assign.py drops
+#		these with remove_zero_value_transactions)
+#	unbalanced: transactions that need an account assigned - same as
+#		assign.unbalanced
+# Only flagged entries go on to the (much slower) regex assignment.
+
+from beancount.core.data import Transaction
+
+def screen_entry(e):
+	""" Returns: (zero, unbalanced) flags of one entry, both False if it
+		isn't a transaction
+	"""
+	if type(e)!=Transaction:
+		return(False,False)
+	postings=e.postings
+	# Simple case: only 1 posting then by defn unbalanced
+	if len(postings)==1:
+		units=postings[0].units
+		return(units!=None and units[0]==0,True)
+	# see if sum of postings is unbalanced in one currency
+	delta=0
+	currency=None
+	for p in postings:
+		units=p.units
+		# Amount is False for a zero number
+		if units and units[0]:
+			delta+=units[0]
+			if currency==None:
+				currency=units[1]
+			elif units[1]!=currency:
+				return(False,False)
+	return(False,delta!=0 and currency!=None)
+
+def screen_entries(entries):
+	""" Flags the entries of one extracted file
+		Arguments:
+			entries: list of entries
+		Returns:
+			(zero, unbalanced) lists of flags, one per entry
+		Notes:
+			Summing the postings in one loop per entry, without building
+			lists and sets, is several times faster than calling
+			assign.unbalanced for each entry
+	"""
+	flags=[screen_entry(e) for e in entries]
+	return([z for z,u in flags],[u for z,u in flags])
@@ -0,0 +1,111 @@
+# Account suggestions for unassigned payees
+#
+# Payees are split into word tokens. An inverted index maps each token to
+# the accounts it was assigned to, from the yaml rules of all accounts and
+# from the payee -> account pairs of the ledger. A new payee votes for
+# accounts with its tokens, rare tokens (e.g. a store name) counting more
+# than common ones (e.g. PURCHASE).
+
+import re
+import math
+from collections import Counter
+
+# generic numbers made by assign.regexify
+number_pattern=re.compile("\\[0-9\\](\\{[0-9]+\\})?")
+token_pattern=re.compile("[A-Z][A-Z0-9]+")
+
+# don't suggest accounts that aren't real assignments
+skip_accounts=["UNASSIGNED"]
+
+def tokens(text):
+	""" Word tokens of a payee or regexify'd payee pattern
+		Returns: list of unique upper case tokens, in order
+	"""
+	found=token_pattern.findall(number_pattern.sub(" ",str(text).upper()))
+	return(list(dict.fromkeys(found)))
+
+def payee_of(e):
+	return(e.narration.split('/')[0].strip())
+
+def narration_accounts(entries):
+	""" Payee -> account pairs of ledger transactions
+		Returns: Counter of (payee, account), where account is any posting
+			account but the first (the account the entry was imported to)
+	"""
+	pairs=Counter()
+	for e in entries:
+		postings=getattr(e,'postings',None)
+		narration=getattr(e,'narration',None)
+		if not postings or not narration:
+			continue
+		payee=payee_of(e)
+		for p in postings[1:]:
+			pairs[(payee,p.account)]+=1
+	return(pairs)
+
+class SuggestionIndex:
+	""" Inverted index of payee tokens to the accounts they were assigned to
+
+		Notes:
+			A payee's score for an account is the sum over its tokens of
+			idf(token) * (fraction of the token's uses with that account),
+			divided by the sum of idf of its known tokens, so 1.0 means
+			every known token only ever went to that account.
+			Lookups only touch the payee's own tokens, so they take
+			microseconds however many rules and entries are indexed.
+	"""
+	def __init__(self):
+		self.postings={} # token:Counter(account:weight)
+		self.docs=0
+
+	def add(self,text,account,weight=1):
+		if account==None or any([s in str(account) for s in skip_accounts]):
+			return
+		toks=tokens(text)
+		if len(toks)==0:
+			return
+		self.docs+=1
+		for t in toks:
+			if not t in self.postings:
+				self.postings[t]=Counter()
+			self.postings[t][account]+=weight
+		return
+
+	def add_rules(self,rules):
+		""" Adds a dict of pattern:account (a yaml rule file)
+		"""
+		for pattern,account in rules.items():
+			if type(pattern)==str and type(account)==str:
+				self.add(pattern,account)
+		return
+
+	def add_history(self,pairs):
+		""" Adds a Counter of (payee, account) from narration_accounts
+		"""
+		for (payee,account),n in pairs.items():
+			self.add(payee,account,n)
+		return
+
+	def idf(self,token):
+		return(math.log((1+self.docs)/(1+len(self.postings[token])))+1)
+
+	def suggest(self,text):
+		""" Returns: (most likely account, score between 0 and 1), or
+			(None, 0) if no token of text is known
+		"""
+		scores=Counter()
+		total=0
+		for t in tokens(text):
+			if not t in self.postings:
+				continue
+			accounts=self.postings[t]
+			w=self.idf(t)
+			total+=w
+			n=sum(accounts.values())
+			for account,c in accounts.items():
+				scores[account]+=w*c/n
+		if total==0:
+			return(None,0)
+		# highest score, then account name, so ties don't depend on order
+		account,score=min(scores.items(),key=lambda x: (-x[1],x[0]))
+		return(account,score/total)
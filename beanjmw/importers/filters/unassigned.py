@@ -0,0 +1,121 @@
+# Store for <Account>_unassigned.yaml and <Account>_payees_unassigned.yaml
+#
+# Each extract run used to append its unassigned payees (or check numbers)
+# to these files, so keys were repeated every run. unassigned_store keeps a
+# keyed map of each file and rewrites the whole file when keys are added:
+# every key is written once, with the value (and date, amount or suggestion
+# comment) it had when first seen. The "# Unassigned ... for <file>" header
+# of each extracted file is kept once at the top.
+
+import os
+from collections import OrderedDict
+
+from beanjmw.importers.filters.cachefile import file_signature, write_atomic
+
+header_prefix="# Unassigned "
+
+def parse_line(line):
+	""" Parses a key: value line written by format_line
+		Returns: (key, value text with any comment) or (None, None)
+	"""
+	line=line.rstrip("\n")
+	if len(line.strip())==0 or line.lstrip().startswith("#"):
+		return(None,None)
+	if line.startswith('"'):
+		end=line.find('":',1)
+		if end < 0:
+			return(None,None)
+		return(line[1:end],line[end+2:].strip())
+	key,sep,value=line.partition(":")
+	if not sep:
+		return(None,None)
+	key=key.strip()
+	if key.isdigit(): # check number
+		key=int(key)
+	return(key,value.strip())
+
+def format_line(key,value):
+	""" Returns: yaml line for a payee pattern or check number key
+	"""
+	if type(key)==int:
+		return(str(key)+":"+(6-len(str(key)))*" "+value+"\n")
+	if len(key) < 40:
+		return("\""+key+"\"" + ":" + (40-len(key))*" " + value + "\n")
+	# really long key...
+	return("\""+key+"\"" + ": " + value + "\n")
+
+def sort_key(key):
+	# check numbers first, in numeric order
+	return((type(key)!=int,key))
+
+class UnassignedStore:
+	""" Merges unassigned keys into yaml files, without duplicates
+
+		Notes:
+			Files are read once and kept in memory until they change on
+			disk (e.g. stage --clean removes them). Keys are written in
+			sorted order, check numbers in numeric order.
+	"""
+	def __init__(self):
+		self.files={} # filename:(signature,headers[],OrderedDict key:value)
+
+	def read(self,filename):
+		""" Returns: (list of header lines, OrderedDict of key:value text)
+			of a file, first value of repeated keys
+		"""
+		if not os.path.isfile(filename):
+			self.files.pop(filename,None)
+			return([],OrderedDict())
+		signature=file_signature(filename)
+		if filename in self.files and self.files[filename][0]==signature:
+			return(self.files[filename][1:])
+		headers=[]
+		items=OrderedDict()
+		with open(filename,'r') as f:
+			for line in f:
+				if line.startswith(header_prefix):
+					if not line in headers:
+						headers.append(line)
+					continue
+				key,value=parse_line(line)
+				if key!=None and not key in items:
+					items[key]=value
+		self.files[filename]=(signature,headers,items)
+		return(headers,items)
+
+	def merge(self,filename,header,items,replace=False):
+		""" Adds new keys to a file and rewrites it
+			Arguments:
+				header: "# Unassigned ... for <extracted file>" comment line
+				items: dict of key:value text (value may end in a comment)
+				replace: start from an empty file instead
+			Returns: number of keys that weren't in the file
+		"""
+		headers,merged=[],OrderedDict()
+		if not replace:
+			headers,merged=self.read(filename)
+			merged=OrderedDict(merged)
+		header=header.rstrip("\n")+"\n"
+		added=0
+		for key,value in items.items():
+			if not key in merged:
+				merged[key]=value
+				added+=1
+		if not header in headers:
+			headers=headers+[header]
+		elif added==0:
+			return(0)
+		self.write(filename,headers,merged)
+		return(added)
+
+	def write(self,filename,headers,items):
+		def write_items(f):
+			f.writelines(headers)
+			for key in sorted(items,key=sort_key):
+				f.write(format_line(key,items[key]))
+		write_atomic(filename,write_items,'w')
+		self.files[filename]=(file_signature(filename),headers,items)
+		return
+
+# shared by check payee and account assignment
+unassigned_store=UnassignedStore()
@@ -0,0 +1,320 @@
+# On-disk cache of importer results for bci
+#
+# Every bci run (and stage --extract runs bci once per ledger account)
+# extracts every download again with each matching importer. Importers in
+# CONFIG wrapped with cached_config keep their extracted entries pickled in
+# cache_dir, keyed by the name and content hash of the file, the importer
+# class and settings, the importer source file and the beanjmw version, so
+# unchanged downloads are only parsed once. cache_dir is outside the 
+# downloads directory, which ingest scans for downloads, and prune_cache 
+# removes entries that weren't used for extract_cache_max_age days.
+#
+# identify() results (N importers x M downloads, some of which parse the
+# whole file) are kept in one small index, cache_dir/identify.pickle, so
+# unchanged downloads are matched without calling identify() again in the
+# identify, extract and archive (file) steps.
+
+import os, sys
+import io
+import hashlib
+import inspect
+import pickle
+import atexit
+import time
+
+from beanjmw.importers.filters.cachefile import file_signature, file_hash, load_pickle, save_pickle
+
+def default_cache_dir():
+	base=os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"),".cache")
+	return(os.path.join(base,"beanjmw","ingest"))
+
+# keep extracted entries in this directory (set extract_cache_dir in 
+# accts.py to change it), not in the downloads directory
+use_extract_cache=True
+cache_dir=default_cache_dir()
+extract_cache_version=3
+# prune_cache removes extracted entries not used for this many days
+extract_cache_max_age=60
+# keep identify() results in cache_dir/identify_cache_file
+use_identify_cache=True
+identify_cache_file="identify.pickle"
+identify_cache_version=1
+
+class IdentifyIndex:
+	""" identify() results of importers for each download, and the
+		content hash of each download
+
+		Arguments:
+			filename: index file, loaded when first needed
+
+		Notes:
+			Results are kept by (content hash, importer key) for each file
+			name. Hashes are only computed again when the size or mtime of 
+			a file changes. save() merges with the index on disk, so bci 
+			processes running at the same time don't lose each other's 
+			results, and drops files that are gone.
+	"""
+	def __init__(self,filename):
+		self.filename=filename
+		self.files=None # file:(mtime_ns,size,sha256)
+		self.results=None # file:{(sha256,importer key):matched}
+		self.changed=False
+		self.hits=0
+		self.misses=0
+
+	def read(self):
+		""" Returns: (files, results) saved in the index file
+		"""
+		index=load_pickle(self.filename,identify_cache_version,"identify cache")
+		if index==None:
+			return({},{})
+		return(index['files'],index['results'])
+
+	def load(self):
+		if self.files==None:
+			self.files,self.results=self.read()
+		return
+
+	def digest(self,filename):
+		""" Returns: sha256 hex digest of the contents of a file
+		"""
+		self.load()
+		filename=os.path.abspath(filename)
+		signature=file_signature(filename)
+		known=self.files.get(filename)
+		if known and known[:2]==signature:
+			return(known[2])
+		sha=file_hash(filename)
+		self.files[filename]=signature+(sha,)
+		self.changed=True
+		return(sha)
+
+	def get(self,filename,importer_key):
+		""" Returns: saved identify() result, or None if not known
+		"""
+		sha=self.digest(filename)
+		matched=self.results.get(os.path.abspath(filename),{}).get((sha,importer_key))
+		if matched==None:
+			self.misses+=1
+		else:
+			self.hits+=1
+		return(matched)
+
+	def put(self,filename,importer_key,matched):
+		sha=self.digest(filename)
+		self.results.setdefault(os.path.abspath(filename),{})[(sha,importer_key)]=matched
+		self.changed=True
+		return
+
+	def save(self):
+		if not self.changed:
+			return
+		files,results=self.read()
+		files.update(self.files)
+		for filename,found in self.results.items():
+			results.setdefault(filename,{}).update(found)
+		# only keep results for the current contents of existing files
+		for filename in list(files):
+			if not os.path.isfile(filename):
+				del files[filename]
+		results={fn:{k:v for k,v in found.items() if k[0]==files[fn][2]} for fn,found in results.items() if fn in files}
+		if save_pickle(self.filename,identify_cache_version,{'files':files,'results':results},"identify cache"):
+			self.changed=False
+		return
+
+# IdentifyIndex of each cache directory, saved when python exits
+identify_indexes={}
+
+def save_identify_indexes():
+	""" Saves the changed indexes in identify_indexes (at exit)
+	"""
+	if use_identify_cache:
+		for index in identify_indexes.values():
+			index.save()
+	return
+
+atexit.register(save_identify_indexes)
+
+def get_identify_index(directory=None):
+	if directory==None:
+		directory=cache_dir
+	filename=os.path.abspath(os.path.join(directory,identify_cache_file))
+	if not filename in identify_indexes:
+		identify_indexes[filename]=IdentifyIndex(filename)
+	return(identify_indexes[filename])
+
+def file_digest(filename,directory=None):
+	""" Returns: sha256 hex digest of the contents of a file
+	"""
+	return(get_identify_index(directory).digest(filename))
+
+def in_cache_dir(filename,directory=None):
+	""" Returns: True if filename is in the cache directory, e.g. when it
+		was set to a directory under the downloads
+	"""
+	if directory==None:
+		directory=cache_dir
+	return(os.path.abspath(filename).startswith(os.path.join(os.path.abspath(directory),"")))
+
+def prune_cache(directory=None,max_age=None):
+	""" Removes extracted entries that weren't read or written for max_age
+		days (extract_cache_max_age if None), and temporary files left 
+		behind by killed processes
+		Returns: number of files removed
+	"""
+	if directory==None:
+		directory=cache_dir
+	if max_age==None:
+		max_age=extract_cache_max_age
+	if not os.path.isdir(directory):
+		return(0)
+	oldest=time.time()-max_age*86400
+	removed=0
+	for fn in os.listdir(directory):
+		if fn==identify_cache_file or not fn.endswith((".pickle",".tmp")):
+			continue
+		try:
+			if os.path.getmtime(os.path.join(directory,fn)) < oldest:
+				os.remove(os.path.join(directory,fn))
+				removed+=1
+		except OSError:
+			pass
+	return(removed)
+
+def package_version():
+	try:
+		from importlib.metadata import version
+		return(version("beanjmw"))
+	except Exception:
+		return("unknown")
+
+def importer_fingerprint(importer):
+	""" Returns: string identifying the importer class, its constructor
+		settings and its source code
+		Notes: settings are the repr of the importer's attributes, so any
+			that show a memory address only cause cache misses
+	"""
+	cls=type(importer)
+	source=""
+	try:
+		source_file=inspect.getfile(cls)
+		st=os.stat(source_file)
+		source="{0}:{1}:{2}".format(source_file,st.st_mtime_ns,st.st_size)
+	except (TypeError,OSError):
+		pass
+	settings=repr(sorted(vars(importer).items()))
+	return("\n".join([cls.__module__,cls.__qualname__,settings,source,package_version()]))
+
+def importer_state(importer):
+	""" Returns: dict of the importer's attributes that can be pickled
+		(e.g. not a namedtuple class made in __init__)
+	"""
+	state={}
+	for k,v in vars(importer).items():
+		try:
+			pickle.dumps(v)
+			state[k]=v
+		except Exception:
+			pass
+	return(state)
+
+def importer_key(importer):
+	return(hashlib.sha256(importer_fingerprint(importer).encode('utf-8')).hexdigest())
+
+class CachedImporter:
+	""" Wraps an importer so identify() and extract() results are read 
+		from the cache
+
+		Arguments:
+			importer: importer from CONFIG, everything but identify and
+				extract is passed through to it
+			cache_dir: directory of the cache, None for the module setting
+
+		Notes:
+			What the importer writes to stderr while extracting, and its
+			attributes after extracting (some importers keep e.g. the
+			currencies they found), are saved too and restored when the
+			entries come from the cache.
+			existing_entries is passed through but isn't part of the key
+			(none of the beanjmw importers use it).
+			identify() results are keyed by the importer settings when it
+			was wrapped, as extract() changes some attributes.
+			Entries extracted in another process are handed over with
+			prefetch and returned by the next extract() of that file.
+	"""
+	def __init__(self,importer,cache_dir=None):
+		self.importer=importer
+		self.cache_dir=cache_dir
+		self.identify_key=importer_key(importer)
+		self.prefetched={} # filename:(entries,messages)
+		self.hits=0
+		self.misses=0
+
+	def __getattr__(self,name):
+		if name=="importer": # not set yet, e.g. while unpickling
+			raise AttributeError(name)
+		return(getattr(self.importer,name))
+
+	def cache_file(self,filename):
+		directory=self.cache_dir
+		if directory==None:
+			directory=cache_dir
+		# entries have the file name in their meta, so it is in the key too
+		key="\n".join([str(extract_cache_version),os.path.abspath(filename),file_digest(filename,self.cache_dir),importer_fingerprint(self.importer)])
+		return(os.path.join(directory,hashlib.sha256(key.encode('utf-8')).hexdigest()+".pickle"))
+
+	def identify(self,file):
+		# the cache's own files aren't downloads
+		if in_cache_dir(file.name,self.cache_dir):
+			return(False)
+		if not use_identify_cache:
+			return(self.importer.identify(file))
+		index=get_identify_index(self.cache_dir)
+		matched=index.get(file.name,self.identify_key)
+		if matched==None:
+			matched=bool(self.importer.identify(file))
+			index.put(file.name,self.identify_key,matched)
+		return(matched)
+
+	def prefetch(self,filename,entries,messages):
+		""" Keeps entries extracted from filename elsewhere for extract()
+		"""
+		self.prefetched[filename]=(entries,messages)
+		return
+
+	def extract(self,file,existing_entries=None):
+		if file.name in self.prefetched:
+			entries,messages=self.prefetched.pop(file.name)
+			sys.stderr.write(messages)
+			return(entries)
+		if not use_extract_cache:
+			return(self.importer.extract(file,existing_entries=existing_entries))
+		cache_file=self.cache_file(file.name)
+		cached=load_pickle(cache_file,extract_cache_version,"extract cache")
+		if cached:
+			self.hits+=1
+			# last used, for prune_cache
+			try:
+				os.utime(cache_file)
+			except OSError:
+				pass
+			sys.stderr.write(cached['messages'])
+			self.importer.__dict__.update(cached['state'])
+			return(cached['entries'])
+		self.misses+=1
+		# keep the importer's messages to repeat them on cache hits
+		stderr=sys.stderr
+		sys.stderr=io.StringIO()
+		try:
+			entries=self.importer.extract(file,existing_entries=existing_entries)
+		finally:
+			messages=sys.stderr.getvalue()
+			sys.stderr=stderr
+			sys.stderr.write(messages)
+		save_pickle(cache_file,extract_cache_version,{'entries':entries,'messages':messages,'state':importer_state(self.importer)},"extract cache")
+		return(entries)
+
+def cached_config(config,cache_dir=None):
+	""" Returns: list of the CONFIG importers wrapped in CachedImporter
+	"""
+	return([x if isinstance(x,CachedImporter) else CachedImporter(x,cache_dir) for x in config])
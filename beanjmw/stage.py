@@ -7,7 +7,6 @@ import argparse
 import shutil
 import sys, os
 import glob
-import subprocess
 
 from beancount.loader import load_file
 from beancount.core.data import Transaction, Balance, Pad
@@ -23,6 +22,10 @@ sys.path.insert(0, download_path)
 # add current path too, so importers work
 sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
 
+from importers.filters.assign import warm_group_cache
+from beanjmw.importers.filters.dedup import update_ledger_index
+from beanjmw import yaml_util
+
 ledger_path = ".."
 staging_path = "../staging"
 archive_path = "../files"
@@ -52,25 +55,20 @@ ap.add_argument("-i","--identify",required=False,help="Identify files to be extr
 ap.add_argument("--archive",required=False,help="Archive files to be extracted",default=False,action="store_true")
 ap.add_argument("-e","--extract",required=False,help="Extract latest downloads, make release candidates, check",default=False,action="store_true")
 ap.add_argument("--clean",required=False,help="Clean up yaml files",default=False,action="store_true")
+ap.add_argument("--warm",required=False,help="Pre-compute cached rule groups for yaml files (speeds up extract)",default=False,action="store_true")
 ap.add_argument("-v","--verbose",required=False,help="Print all details",default=False,action="store_true")
 ap.add_argument("--update",required=False,help="Backup orig ledger, move orig to delete file, move release candidate to orig",default=False,action="store_true")
 ap.add_argument("--remove",required=False,help="Remove any undeleted safety files",default=False,action="store_true")
 ap.add_argument("--test",required=False,help="Just print commands to be executed, but don't actually do anything",default=False,action="store_true")
 ap.add_argument("--force",required=False,help="Force file update even if bean-check fails",default=False,action="store_true")
 ap.add_argument("--split",required=False,help="Split this file into sub-ledgers using ledgersbyacct in accts.py",default='')
+ap.add_argument("-j","--jobs",required=False,help="Number of processes extracting downloads (default extract_jobs in accts.py, or 1)",default=None,type=int)
 ap.add_argument("--last",required=False,help="Prints latest date in each ledger (useful to know when downloading new files",default=False,action='store_true')
 
-clargs = ap.parse_args(sys.argv[1:])
-
-if len(sys.argv)==1: # default to -h 
-	ap.print_usage()
-	sys.exit(0)
-
-try:
-	from accts import ledgersbyacct
-except ImportError as ie:
-	sys.stderr.write(bcolors.FAIL + "Can't import ledgersbyacct from accts: {0}\n".format(ie) + bcolors.ENDC)
-	sys.exit(1)
+# set by main - module defaults, so the functions below can be used when
+# stage is imported (e.g. by extract worker processes)
+clargs = ap.parse_args([])
+ledgersbyacct = {}
 
 def is_nothing(fn):
 	if os.path.isfile(fn):
@@ -88,18 +86,17 @@ def is_nothing(fn):
 	return(nothing)
 
 def check(acct,rc_path):
+	""" Loads a release candidate like bean-check
+		Returns: True if there are no errors
+	"""
 	passed = False
-	p = subprocess.Popen(["bean-check",rc_path],stderr=subprocess.PIPE)
-	lines = p.stderr.readlines()
-	if len(lines) > 0:
+	entries, errors, options = load_file(rc_path)
+	if len(errors) > 0:
 		full_rc_path = os.path.abspath(rc_path)
-		nerr = len([x for x in lines if full_rc_path in x.decode('utf-8')])
+		nerr = len([e for e in errors if e.source and e.source.get('filename')==full_rc_path])
 		print(bcolors.FAIL+ "Errors for {0}, {1}: {2}".format(acct,rc_path,nerr) + bcolors.ENDC)
 		if clargs.verbose:
-			for x in lines:
-				l = x.decode('utf-8').strip()
-				if len(l) > 0:
-					print(l)
+			printer.print_errors(errors,file=sys.stdout)
 	else:
 		print(bcolors.OKGREEN+"Check passed for {0}, {1}".format(acct,rc_path)+bcolors.ENDC)
 		passed=True
@@ -133,65 +130,60 @@ def remove_marked():
 			sys.stderr.write("Remember to delete {0} files manually\n".format(delete_suffix))
 	return(error)
 
-def run_command(com):
+def run_step(description,fn,*args,**kwargs):
+	""" Calls fn, or just prints description with --test
+		Returns: (error message or None, result of fn)
+	"""
 	error = None
+	result = None
 	if clargs.test:
-		print(com)
+		print(description)
 	else:
 		try:
-			os.system(com)
+			result = fn(*args,**kwargs)
 		except Exception as ex:
-			sys.stderr.write(bcolors.FAIL + "Error: run_command: {0}: {1}".format(com,str(ex))+bcolors.ENDC)
+			sys.stderr.write(bcolors.FAIL + "Error: {0}: {1}\n".format(description,str(ex))+bcolors.ENDC)
 			error = str(ex)
-	return(error)
+	return(error,result)
+
+def concat_files(srcs,dst):
+	""" Writes the contents of srcs, one after the other, to dst
+	"""
+	with open(dst,'wb') as f:
+		for src in srcs:
+			with open(src,'rb') as fs:
+				shutil.copyfileobj(fs,f)
+	return
+
+def last_date(epath):
+	""" Returns: date of the latest transaction in a ledger, or None
+	"""
+	entries, errors, options = load_file(epath)
+	dates=[e.date for e in entries if type(e)==Transaction]
+	if len(dates)==0:
+		return(None)
+	return(max(dates))
 
 def print_last():
 	for acct in ledgersbyacct:
 		epath, new_path, rc_path, bpath = get_filenames(ledgersbyacct[acct])
 		if os.path.isfile(epath):
-			com = "bean-query {0} 'select last(date)'".format(epath)
 			sys.stderr.write(bcolors.OKBLUE + "Latest record for {0}:".format(epath) + bcolors.ENDC + "\n")
-			run_command(com)
+			err,last=run_step("last_date {0}".format(epath),last_date,epath)
+			if last:
+				print(last)
 			sys.stderr.write('\n')
-
-def decode_std(raw):
-	std_lines=[]
-	draw=raw.decode('UTF-8').split('\n')
-	for x in draw:
-		if len(x) > 0:
-			std_lines.append(x)
-	return(std_lines)
-
-def run_command_std(com):
-	error = None
-	stdout_lines=[]
-	stderr_lines=[]
-	if clargs.test:
-		print(com)
-	else:
-		try:
-			p = subprocess.Popen(com.split(' '),stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			stdout_raw, stderr_raw=p.communicate()
-			stdout_lines=decode_std(stdout_raw)
-			stderr_lines=decode_std(stderr_raw)
-
-		except Exception as ex:
-			sys.stderr.write(bcolors.FAIL + "Error: run_command_std: {0}: {1}".format(com,str(ex))+bcolors.ENDC)
-			error = str(ex)
-	return(error,stdout_lines,stderr_lines)
+	return
 
 def identify_files():
+	from beanjmw import bci
 	accts=[]
-	ecom = "python -m beanjmw.bci identify"
-	err,stdout_lines,stderr_lines=run_command_std(ecom)
-	# re-parse identify output to something simpler unless verbose
-	if clargs.verbose:
-		[print(l) for l in stdout_lines]
-	for idx in range(0,int(len(stdout_lines)),3):
-		fn = os.path.split(stdout_lines[idx].split()[-1])[-1]
-		frag = stdout_lines[idx+1].split(".Importer")[0]
-		imptr = frag.split()[-1]
-		acct = stdout_lines[idx+2].split()[-1]
+	err,identified=run_step("bci identify",bci.identify_downloads)
+	for filename,name,acct in identified or []:
+		if clargs.verbose:
+			print("**** {0}\nImporter:    {1}\nAccount:     {2}".format(filename,name,acct))
+		fn = os.path.split(filename)[-1]
+		imptr = name.split(".Importer")[0]
 		print(bcolors.OKBLUE + fn + bcolors.ENDC)
 		print("\t{0} ({1})".format(acct,imptr))
 # Note: Went back to defaulting to append (with multiple input files you
@@ -204,51 +196,47 @@ def identify_files():
 	return
 
 def archive_files():
+	from beanjmw import bci
 	make_path(archive_path)
-	ecom = "python -m beanjmw.bci file -o {0} -n".format(archive_path)
-	err,stdout_lines,stderr_lines=run_command_std(ecom)
-	# re-parse identify output to something simpler unless verbose
-	if clargs.verbose:
-		[print(l) for l in stdout_lines]
-	else:
-		for idx in range(0,int(len(stdout_lines)),4):
-			fn = stdout_lines[idx+3].split()[-1]
-			print(bcolors.OKBLUE + fn + bcolors.ENDC)
+	err,jobs=run_step("bci file -o {0} -n".format(archive_path),bci.archive_downloads,archive_path,dry_run=True)
+	for src,dst in jobs or []:
+		if clargs.verbose:
+			print("{0} => {1}".format(src,dst))
+		else:
+			print(bcolors.OKBLUE + dst + bcolors.ENDC)
 	check_fatal_error(err)
-	if len(stdout_lines) > 0 or clargs.test: # something to do
+	if jobs or clargs.test: # something to do
 		doit = input("Are these destinations OK [Yes/n]?")
 		if doit=="Y" or doit=="Yes":
 			print("Archiving...")
-			ecom = "python -m beanjmw.bci file -o {0}".format(archive_path)
-			if clargs.test:
-				print(ecom)
-			else: # really do it
-				err,stdout_lines,stderr_lines=run_command_std(ecom)
-				check_fatal_error(err)
+			err,jobs=run_step("bci file -o {0}".format(archive_path),bci.archive_downloads,archive_path)
+			check_fatal_error(err)
 		else:
 			print("Skipping - files are still in place") 
 	return
 
 def extract_files():
+	from beanjmw import bci
 	make_path(staging_path)
+	# extract the downloads once and write every _new file
+	if not clargs.check:
+		if clargs.jobs!=None:
+			bci.extract_jobs = clargs.jobs
+		jobs = []
+		for acct in ledgersbyacct:
+			epath, new_path, rc_path, bpath = get_filenames(ledgersbyacct[acct])
+			jobs.append((acct,epath,new_path))
+		check_fatal_error(run_step("bci extract_accounts -l {0} -o {1} -j {2}".format(ledger_path,staging_path,bci.extract_jobs),bci.extract_accounts,jobs)[0])
 	for acct in ledgersbyacct:
 		epath, new_path, rc_path, bpath = get_filenames(ledgersbyacct[acct])
-		if os.path.isfile(epath):
-			ecom = "python -m beanjmw.bci extract -e {0} -a {1} > {2}".format(epath,acct,new_path)
-		else:
-			ecom = "python -m beanjmw.bci extract -a {0} > {1}".format(acct,new_path)
 		if not clargs.check:
-			check_fatal_error(run_command(ecom))
 			if is_nothing(new_path):
 				print(bcolors.OKBLUE+"Nothing to do for {0}, {1}".format(acct,new_path)+bcolors.ENDC)
-			#	ccom = "cat {0} > {1}".format(new_path,rc_path)
-			#	check_fatal_error(run_command(ccom))
 			else:
+				srcs = [new_path]
 				if os.path.isfile(epath):
-					ccom = "cat {0} {1} > {2}".format(epath,new_path,rc_path)
-				else:
-					ccom = "cat {0} > {1}".format(new_path,rc_path)
-				check_fatal_error(run_command(ccom))
+					srcs = [epath,new_path]
+				check_fatal_error(run_step("cat {0} > {1}".format(" ".join(srcs),rc_path),concat_files,srcs,rc_path)[0])
 		# do a check of result
 		if os.path.isfile(rc_path):
 			passed = check(acct,rc_path)
@@ -325,6 +313,9 @@ def update_files():
 		if not os.path.isfile(epath) and os.path.isfile(rc_path):
 			if clone_file(rc_path,epath) != None:
 				ok_remove=False
+			elif not clargs.test:
+				# add the new entries to the saved dedup fingerprints
+				update_ledger_index(epath,new_path)
 		else:
 			if os.path.isfile(rc_path):
 				sys.stderr.write("File exists - can't update {0}\n".format(epath))
@@ -384,11 +375,7 @@ def clean_yaml():
 	yamls = [f for f in glob.glob(os.path.join(yaml_path, "*.yaml")) if not "unassigned" in f]
 	for yfile in yamls:
 		tdst = yfile + ".tmp"
-		com = "python -m beanjmw.yaml_util -e {0} -sp > {1}".format(
-					yfile,
-					tdst,	
-				)
-		check_fatal_error(run_command(com))
+		check_fatal_error(run_step("yaml_util -e {0} -sp > {1}".format(yfile,tdst),simplify_yaml,yfile,tdst)[0])
 		check_fatal_error(clone_file(yfile, yfile+delete_suffix))
 		check_fatal_error(clone_file(tdst,yfile))
 	# get rid of marked files
@@ -396,6 +383,23 @@ def clean_yaml():
 
 	return
 
+def simplify_yaml(yfile,tdst):
+	""" Writes the sorted and simplified rules of yfile to tdst
+	"""
+	with open(tdst,'w') as f:
+		yaml_util.main(["-e",yfile,"-sp"],output=f)
+	return
+
+def warm_yaml():
+	''' refreshes the cached rule groups of each account yaml file
+	'''
+	if clargs.test:
+		print("warm_group_cache {0}".format(yaml_path))
+		return
+	for yfile in warm_group_cache(yaml_path):
+		print(bcolors.OKBLUE + "Cached rule groups for {0}".format(os.path.basename(yfile)) + bcolors.ENDC)
+	return
+
 def fix_transfer(e,acct,transfer_accts):
 	''' Changes inter-account postings from acct into intermediate
 		transfer account ("Assets:Transfer")
@@ -534,25 +538,51 @@ def split_ledger():
 
 ##### Start of script
 
-# typical workflow is: 
-# 	last -> [manually download files from last dates] ->
-# 	identify -> extract -> update -> clean -> remove -> archive
-if clargs.identify:
-	identify_files()
-if clargs.extract or clargs.check:
-	extract_files()
-if clargs.update:
-	update_files()
-if clargs.clean:
-	clean_yaml()
-if clargs.remove and not clargs.update:
-	remove_marked()
-if clargs.archive:
-	archive_files()
-
-# some other useful functions
-if len(clargs.split) > 0:
-	split_ledger()
-if clargs.last:
-	print_last()
-
+def main(argv=None):
+	""" Runs the stage steps given on the command line
+		Arguments: argv = list of arguments, sys.argv[1:] if None
+	"""
+	global clargs, ledgersbyacct
+	if argv==None:
+		argv=sys.argv[1:]
+	clargs = ap.parse_args(argv)
+
+	if len(argv)==0: # default to -h 
+		ap.print_usage()
+		return(0)
+
+	try:
+		from accts import ledgersbyacct
+	except ImportError as ie:
+		sys.stderr.write(bcolors.FAIL + "Can't import ledgersbyacct from accts: {0}\n".format(ie) + bcolors.ENDC)
+		return(1)
+
+	# typical workflow is: 
+	# 	last -> [manually download files from last dates] ->
+	# 	identify -> extract -> update -> clean -> warm -> remove -> archive
+	if clargs.identify:
+		identify_files()
+	if clargs.extract or clargs.check:
+		extract_files()
+	if clargs.update:
+		update_files()
+	if clargs.clean:
+		clean_yaml()
+	if clargs.warm:
+		warm_yaml()
+	if clargs.remove and not clargs.update:
+		remove_marked()
+	if clargs.archive:
+		archive_files()
+
+	# some other useful functions
+	if len(clargs.split) > 0:
+		split_ledger()
+	if clargs.last:
+		print_last()
+	return(0)
+
+# extract worker processes (-j) import this module again, so only run the
+# script when it is run
+if __name__=='__main__':
+	sys.exit(main())
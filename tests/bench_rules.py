@@ -0,0 +1,113 @@
+# Benchmark for yaml rule matching, not run by pytest
+#
+# Usage: python tests/bench_rules.py [--rules 250,1000,4000] [--entries 2000]
+#
+# Prints assign throughput (entries/sec) against number of rules for:
+#	baseline - best_match loop over all patterns (original assign_entry)
+#	regex - RuleMatcher with every rule compiled as a regex
+#	literal - RuleMatcher with literal rules in the hash/trie
+
+import argparse
+import random
+import string
+import sys
+import time
+
+from beanjmw.importers.filters import assign, rules
+from beanjmw.importers.filters.rules import RuleMatcher
+from beancount.core.data import Transaction
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--rules", "-r", required=False, help='Comma delimited list of rule counts', default='250,1000,4000')
+ap.add_argument("--entries", "-n", required=False, help='Number of entries to assign', default=2000, type=int)
+ap.add_argument("--baseline_entries", "-b", required=False, help='Number of entries for (slow) baseline', default=100, type=int)
+ap.add_argument("--seed", "-s", required=False, help='Random seed', default=1, type=int)
+
+def random_payee():
+	words = [''.join(random.choice(string.ascii_uppercase) for _ in range(random.randint(3, 9))) for _ in range(random.randint(1, 3))]
+	if random.random() < 0.4:
+		words.append('#' + str(random.randint(100, 99999)))
+	if random.random() < 0.2:
+		words.insert(0, 'Debit Card Purchase -')
+	return ' '.join(words)
+
+def make_rules(n_rules):
+	""" regexify-style rules, plus a few true regexes """
+	assignLUT = {}
+	payees = []
+	while len(assignLUT) < n_rules:
+		payee = random_payee()
+		if random.random() < 0.05:
+			pattern = '(' + payee.split()[0] + '|' + payee.split()[-1] + ')'
+		else:
+			pattern = assign.regexify(payee)
+		assignLUT[pattern] = 'Expenses:X' + str(len(assignLUT) % 50)
+		payees.append(payee)
+	return assignLUT, payees
+
+def make_entries(payees, n_entries):
+	entries = []
+	for _ in range(n_entries):
+		if random.random() < 0.7: # a known payee with a different number
+			payee = random.choice(payees)
+			payee = ''.join([str(random.randint(0, 9)) if c.isdigit() else c for c in payee])
+		else:
+			payee = random_payee()
+		entries.append(Transaction({}, None, '*', None, payee + ' / memo', None, None, []))
+	return entries
+
+def baseline_match(e, assignLUT, assign_groups):
+	for pattern in assignLUT:
+		best_pattern = assign.best_match(e, pattern, assign_groups[pattern])
+		if len(best_pattern) > 0:
+			return best_pattern
+	return ""
+
+def run_matcher(entries, matcher):
+	return [matcher.match(e.narration.split(' / ')[0].strip(), e.meta.get('category')) for e in entries]
+
+def rate(n, seconds):
+	return n / max(seconds, 1e-9)
+
+if __name__ == '__main__':
+	clargs = ap.parse_args(sys.argv[1:])
+	random.seed(clargs.seed)
+	# time the matching itself, not the payee memo
+	rules.memo_size = 0
+	print("rules\tliteral\tbaseline/s\tregex/s\tliteral/s\tbuild_regex(s)\tbuild_literal(s)")
+	for n_rules in [int(x) for x in clargs.rules.split(',')]:
+		assignLUT, payees = make_rules(n_rules)
+		assign_groups = assign.group_regex(assignLUT)
+		entries = make_entries(payees, clargs.entries)
+
+		t0 = time.time()
+		base = [baseline_match(e, assignLUT, assign_groups) for e in entries[:clargs.baseline_entries]]
+		t_base = time.time() - t0
+
+		rules.literal_rules = False
+		t0 = time.time()
+		regex_matcher = RuleMatcher(assignLUT, assign_groups)
+		b_regex = time.time() - t0
+		t0 = time.time()
+		res_regex = run_matcher(entries, regex_matcher)
+		t_regex = time.time() - t0
+
+		rules.literal_rules = True
+		t0 = time.time()
+		literal_matcher = RuleMatcher(assignLUT, assign_groups)
+		b_literal = time.time() - t0
+		t0 = time.time()
+		res_literal = run_matcher(entries, literal_matcher)
+		t_literal = time.time() - t0
+
+		assert res_regex == res_literal, "literal and regex matchers disagree"
+		assert base == res_literal[:len(base)], "matcher disagrees with baseline"
+		print("{0}\t{1}\t{2:.0f}\t{3:.0f}\t{4:.0f}\t{5:.3f}\t{6:.3f}".format(
+			n_rules,
+			literal_matcher.n_literal,
+			rate(len(base), t_base),
+			rate(len(entries), t_regex),
+			rate(len(entries), t_literal),
+			b_regex,
+			b_literal,
+		))
@@ -0,0 +1,71 @@
+# Benchmark for yaml_util --similar, not run by pytest
+#
+# Usage: python tests/bench_similar.py [--rules 500,1000,2000,4000] [--accounts 50]
+#
+# Prints seconds to find redundant rules against number of rules for:
+#	all_pairs - re.search over all pattern pairs (original yaml_util)
+#	index - rules.redundant_patterns (by account, with SubsumptionIndex)
+
+import argparse
+import random
+import string
+import sys
+import time
+
+from beanjmw.importers.filters import assign, rules
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--rules", "-r", required=False, help='Comma delimited list of rule counts', default='500,1000,2000,4000')
+ap.add_argument("--accounts", "-a", required=False, help='Number of accounts rules assign to', default=50, type=int)
+ap.add_argument("--seed", "-s", required=False, help='Random seed', default=1, type=int)
+
+def random_payee():
+	words = [''.join(random.choice(string.ascii_uppercase) for _ in range(random.randint(3, 9))) for _ in range(random.randint(1, 3))]
+	if random.random() < 0.4:
+		words.append('#' + str(random.randint(100, 99999)))
+	return ' '.join(words)
+
+def make_entries(n_rules, n_accounts):
+	""" regexify-style rules, some extending an earlier rule, plus a few
+		true regexes
+	"""
+	entries = {}
+	payees = []
+	while len(entries) < n_rules:
+		if len(payees) > 0 and random.random() < 0.2:
+			payee = random.choice(payees) + ' ' + random_payee()
+		else:
+			payee = random_payee()
+		if random.random() < 0.05:
+			pattern = '(' + payee.split()[0] + '|' + payee.split()[-1] + ')'
+		else:
+			pattern = assign.regexify(payee)
+		entries[pattern] = 'Expenses:X' + str(random.randint(0, n_accounts - 1))
+		payees.append(payee)
+	return dict(sorted(entries.items()))
+
+def all_pairs(entries):
+	remove_pattern = {}
+	removed = 0
+	for p1 in entries:
+		for p2 in entries:
+			if p1 != p2 and rules.re.search(p1, p2):
+				if entries[p1] == entries[p2]:
+					remove_pattern[p2] = True
+					removed += 1
+	return remove_pattern, removed
+
+if __name__ == '__main__':
+	clargs = ap.parse_args(sys.argv[1:])
+	random.seed(clargs.seed)
+	print("rules\tremoved\tall_pairs(s)\tindex(s)")
+	for n_rules in [int(x) for x in clargs.rules.split(',')]:
+		entries = make_entries(n_rules, clargs.accounts)
+		t0 = time.time()
+		base = all_pairs(entries)
+		t_base = time.time() - t0
+		t0 = time.time()
+		res = rules.redundant_patterns(entries)
+		t_index = time.time() - t0
+		assert (set(base[0]), base[1]) == (set(res[0]), res[1]), "index disagrees with all pairs"
+		print("{0}\t{1}\t{2:.3f}\t{3:.3f}".format(n_rules, res[1], t_base, t_index))
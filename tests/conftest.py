@@ -0,0 +1,9 @@
+import pytest
+from beanjmw.importers import ingest_cache
+
+@pytest.fixture(autouse=True)
+def extract_cache(tmp_path, monkeypatch):
+	# importers run by the tests (e.g. bci.filter_entries) keep their
+	# cache in the test directory, and its identify index isn't saved at exit
+	monkeypatch.setattr(ingest_cache, 'cache_dir', str(tmp_path / 'ingest_cache'))
+	monkeypatch.setattr(ingest_cache, 'identify_indexes', {})
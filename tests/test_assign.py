@@ -0,0 +1,353 @@
+import datetime
+import os
+import re
+from beanjmw.importers.filters import assign
+from beanjmw.importers.filters import rules
+from beanjmw.importers.filters.rules import RuleMatcher
+from beancount.core.data import Transaction, Posting, Amount, D
+
+# rules in yaml file order, some subsume others
+assignLUT = {
+	'AMAZON':'Expenses:Shopping',
+	'AMAZON MKTPLACE':'Expenses:Shopping:Marketplace',
+	'SAFEWAY #[0-9]{4}':'Expenses:Food',
+	'(?i)costco':'Expenses:Costco',
+	'(GAS|FUEL) STATION':'Expenses:Auto:Gas',
+	'^A$':'Expenses:Single',
+	'Groceries':'Expenses:Food',
+}
+
+payees = [
+	('AMAZON MKTPLACE PMTS', None),
+	('AMAZON.COM', None),
+	('SAFEWAY #1234', None),
+	('SAFEWAY', 'Groceries'),
+	('Costco Wholesale', None),
+	('SHELL FUEL STATION', None),
+	('A', None),
+	('AB', None),
+	('NOBODY', 'Nothing'),
+]
+
+def make_entry(payee, category):
+	meta = {}
+	if category:
+		meta['category'] = category
+	posting = Posting('Liabilities:Card', Amount(D('-10.00'), 'USD'), None, None, None, {})
+	return Transaction(meta, None, '*', None, payee + ' / memo', None, None, [posting])
+
+def loop_match(e, assign_groups):
+	# reference: first pattern in file order, refined by best_match
+	for pattern in assignLUT:
+		best = assign.best_match(e, pattern, assign_groups[pattern])
+		if len(best) > 0:
+			return best
+	return ""
+
+def test_RuleMatcher(monkeypatch):
+	assign_groups = assign.group_regex(assignLUT)
+	# block boundaries must not change which rule is found first
+	for rules_per_block in [1, 2, 3, rules.rules_per_block]:
+		monkeypatch.setattr(rules, 'rules_per_block', rules_per_block)
+		matcher = RuleMatcher(assignLUT, assign_groups)
+		for payee, category in payees:
+			e = make_entry(payee, category)
+			assert matcher.match(payee, category) == loop_match(e, assign_groups), payee
+	assert matcher.match('AMAZON MKTPLACE PMTS') == 'AMAZON MKTPLACE'
+	assert matcher.match('SAFEWAY', 'Groceries') == 'Groceries'
+	assert matcher.match('NOBODY', 'Nothing') == ''
+
+def test_AssignEntry():
+	assign_groups = assign.group_regex(assignLUT)
+	e = make_entry('AMAZON MKTPLACE PMTS', None)
+	assert assign.assign_entry(e, assignLUT, assign_groups)
+	assert e.postings[1].account == 'Expenses:Shopping:Marketplace'
+	assert e.postings[1].units == Amount(D('10.00'), 'USD')
+	e = make_entry('NOBODY', None)
+	assert not assign.assign_entry(e, assignLUT, assign_groups)
+	assert len(e.postings) == 1
+
+def test_GroupCache(tmp_path):
+	account_file = str(tmp_path / 'Liabilities_Card.yaml')
+	with open(account_file, 'w') as f:
+		[f.write('"{0}": {1}\n'.format(k, v)) for k, v in assignLUT.items()]
+	groups = assign.cached_group_regex(account_file, assignLUT)
+	assert groups == assign.group_regex(assignLUT)
+	assert os.path.isfile(str(tmp_path / ('Liabilities_Card' + assign.group_cache_suffix)))
+	# change some rules, only those get re-grouped
+	changed = dict(assignLUT)
+	del changed['AMAZON MKTPLACE']
+	changed['SAFEWAY'] = 'Expenses:Food'
+	changed['AMAZON PRIME'] = 'Expenses:Shopping:Prime'
+	with open(account_file, 'w') as f:
+		[f.write('"{0}": {1}\n'.format(k, v)) for k, v in changed.items()]
+	assert assign.cached_group_regex(account_file, changed) == assign.group_regex(changed)
+	assert assign.warm_group_cache(str(tmp_path)) == [account_file]
+
+def test_Classify(monkeypatch):
+	assert rules.classify('SAFEWAY') == (list('SAFEWAY'), False, False)
+	assert rules.classify('^A$') == (['A'], True, True)
+	steps, anchored_start, anchored_end = rules.classify(assign.regexify('SAFEWAY #1234'))
+	assert steps == list('SAFEWAY ') + [rules.ANY] + [rules.DIGIT] * 4
+	for pattern in ['(GAS|FUEL) STATION', '(?i)costco', 'AB*', '[0-9]+', '^$', 'A\\d']:
+		assert rules.classify(pattern) == None, pattern
+	# literal rules and regex rules must find the same matches
+	assign_groups = assign.group_regex(assignLUT)
+	monkeypatch.setattr(rules, 'literal_rules', False)
+	regex_matcher = RuleMatcher(assignLUT, assign_groups)
+	monkeypatch.setattr(rules, 'literal_rules', True)
+	literal_matcher = RuleMatcher(assignLUT, assign_groups)
+	assert regex_matcher.n_literal == 0 and literal_matcher.n_literal == 5
+	for payee, category in payees + [('SAFEWAY #12', None), ('XA', None), ('A\n', None)]:
+		assert regex_matcher.match(payee, category) == literal_matcher.match(payee, category), payee
+
+def test_AssignWorkers(tmp_path, monkeypatch):
+	with open(str(tmp_path / 'Liabilities_Card.yaml'), 'w') as f:
+		[f.write('"{0}": {1}\n'.format(k, v)) for k, v in assignLUT.items()]
+	accounts = [('f1', 'Liabilities:Card'), ('f2', 'Liabilities:Other'), ('f3', 'Liabilities:Card')]
+	def run(workers):
+		extracted = [(fn, [make_entry(p, c) for p, c in payees]) for fn, _ in accounts]
+		monkeypatch.setattr(assign, 'dir_path', str(tmp_path / str(workers)))
+		os.makedirs(assign.dir_path)
+		os.link(str(tmp_path / 'Liabilities_Card.yaml'), os.path.join(assign.dir_path, 'Liabilities_Card.yaml'))
+		monkeypatch.setattr(assign, 'assign_workers', workers)
+		res = assign.assign_accounts(extracted, None, accounts)
+		unassigned = {}
+		for fn in sorted(os.listdir(assign.dir_path)):
+			if fn.endswith('_unassigned.yaml'):
+				with open(os.path.join(assign.dir_path, fn)) as f:
+					unassigned[fn] = f.read()
+		return res, unassigned
+	serial = run(1)
+	assert [fn for fn, _ in serial[0]] == ['new_opens', 'f1', 'f2', 'f3']
+	assert sorted(serial[1]) == ['Liabilities_Card_unassigned.yaml', 'Liabilities_Other_unassigned.yaml']
+	assert run(3) == serial
+
+def test_Memo(tmp_path, monkeypatch):
+	account_file = str(tmp_path / 'Liabilities_Card.yaml')
+	with open(account_file, 'w') as f:
+		[f.write('"{0}": {1}\n'.format(k, v)) for k, v in assignLUT.items()]
+	assign_groups = assign.group_regex(assignLUT)
+	matcher = RuleMatcher(assignLUT, assign_groups)
+	expected = [matcher.find_match(p, c) for p, c in payees]
+	assert [matcher.match(p, c) for p, c in payees + payees] == expected + expected
+	assert matcher.memo_hits == len(payees)
+	assign.save_memo(account_file, matcher.memo)
+	memo = assign.load_memo(account_file)
+	assert len(memo) == len(payees)
+	matcher = RuleMatcher(assignLUT, assign_groups, memo)
+	assert [matcher.match(p, c) for p, c in payees] == expected
+	assert matcher.memo_misses == 0
+	# editing the rules drops the memo
+	with open(account_file, 'a') as f:
+		f.write('"NOBODY": Expenses:Nobody\n')
+	assert assign.load_memo(account_file) == {}
+	# LRU
+	monkeypatch.setattr(rules, 'memo_size', 2)
+	matcher = RuleMatcher(assignLUT, assign_groups)
+	[matcher.match(p, c) for p, c in payees]
+	assert list(matcher.memo) == [tuple(x) for x in payees[-2:]]
+
+def test_RuleProfiler(tmp_path, monkeypatch):
+	assign_groups = assign.group_regex(assignLUT)
+	matcher = RuleMatcher(assignLUT, assign_groups)
+	profiler = rules.RuleProfiler(assignLUT, assign_groups)
+	assert [profiler.match(p, c) for p, c in payees] == [matcher.match(p, c) for p, c in payees]
+	# 'AMAZON' matched first, the longer 'AMAZON MKTPLACE' won once
+	assert profiler.stats['AMAZON'][:4] == [1, 2, 0, 1]
+	assert profiler.stats['AMAZON MKTPLACE'][:4] == [1, 0, 1, 0]
+	assert profiler.stats['(?i)costco'][4] > 0
+	with open(str(tmp_path / 'Liabilities_Card.yaml'), 'w') as f:
+		[f.write('"{0}": {1}\n'.format(k, v)) for k, v in assignLUT.items()]
+	monkeypatch.setattr(assign, 'dir_path', str(tmp_path))
+	monkeypatch.setattr(assign, 'profile_rules', True)
+	extracted = [(fn, [make_entry(p, c) for p, c in payees]) for fn in ['f1', 'f2']]
+	assign.assign_accounts(extracted, None, [('f1', 'Liabilities:Card'), ('f2', 'Liabilities:Card')])
+	with open(str(tmp_path / ('Liabilities_Card' + assign.profile_suffix))) as f:
+		rows = [line.rstrip('\n').split('\t') for line in f]
+	assert rows[0][:4] == ['pattern', 'account', 'kind', 'hits']
+	assert rows[1][:7] == ['AMAZON', 'Expenses:Shopping', 'literal', '2', '4', '0', '2']
+	assert len(rows) == len(assignLUT) + 2
+
+def all_pairs(entries):
+	# reference: yaml_util --similar before the index
+	remove_pattern = {}
+	removed = 0
+	for p1 in entries:
+		for p2 in entries:
+			if p1 != p2 and re.search(p1, p2) and entries[p1] == entries[p2]:
+				remove_pattern[p2] = True
+				removed += 1
+	return remove_pattern, removed
+
+def test_RedundantPatterns():
+	entries = dict(assignLUT)
+	entries.update({
+		'AMAZON PRIME': 'Expenses:Shopping',
+		'AMAZON.COM': 'Expenses:Shopping',
+		'SAFEWAY #1234': 'Expenses:Food',
+		'SAFEWAY #[0-9]{4} FUEL': 'Expenses:Food',
+		'GAS STATION 12': 'Expenses:Auto:Gas',
+		'Costco Gas': 'Expenses:Costco',
+		'AM': 'Expenses:Other',
+		'AMAZON MKTPLACE PMTS': 'Expenses:Shopping',
+	})
+	remove_pattern, removed = rules.redundant_patterns(entries)
+	assert (sorted(remove_pattern), removed) == (lambda r: (sorted(r[0]), r[1]))(all_pairs(entries))
+	assert 'AMAZON PRIME' in remove_pattern
+	assert 'AMAZON MKTPLACE' not in remove_pattern
+	index = rules.SubsumptionIndex(list(entries))
+	for p1 in entries:
+		assert index.subsumed(p1) == [p2 for p2 in entries if p1 != p2 and re.search(p1, p2)]
+	assert rules.required_literal('^SAFEWAY #[0-9]{4}.x$') == 'SAFEWAY #'
+	assert rules.required_literal('(GAS|FUEL)') == None
+
+def test_RuleStore(tmp_path):
+	from beanjmw.importers.filters.rulestore import RuleStore
+	account_file = str(tmp_path / 'Liabilities_Card.yaml')
+	with open(account_file, 'w') as f:
+		[f.write('"{0}": {1}\n'.format(k, v)) for k, v in assignLUT.items()]
+	store = RuleStore()
+	assert store.load(account_file) == assignLUT
+	assert list(store.load(account_file)) == list(assignLUT)
+	assert store.compiled(account_file)['(?i)costco'].search('COSTCO')
+	assert store.loads == 1
+	# a new process loads the pickled file
+	other = RuleStore()
+	assert other.load(account_file) == assignLUT
+	assert other.loads == 0
+	with open(account_file, 'a') as f:
+		f.write('"NEW": Expenses:New\n')
+	assert store.load(account_file)['NEW'] == 'Expenses:New'
+	assert store.loads == 2
+	with open(account_file, 'w') as f:
+		f.write('')
+	assert store.load(account_file) == {}
+	with open(account_file, 'w') as f:
+		f.write('- a list\n')
+	try:
+		store.load(account_file)
+		assert False
+	except ValueError:
+		pass
+
+def test_CheckPayees(tmp_path, monkeypatch):
+	entries = [make_entry(p, None)._replace(date=datetime.date(2021, 1, 1)) for p in ['Check 101', 'CHECK  102', 'check', 'SAFEWAY', 'Check 103']]
+	entries.append(None)
+	assert assign.check_numbers(entries) == [101, 102, None, None, 103, None]
+	assert assign.check_numbers(entries) == [assign.is_check(e) for e in entries]
+	with open(str(tmp_path / 'Assets_Checking_payees.yaml'), 'w') as f:
+		f.write('101: Landlord\n"102": Quoted\n')
+	monkeypatch.setattr(assign, 'dir_path', str(tmp_path))
+	monkeypatch.setattr(assign, 'unassigned_file_mode', 'w')
+	new_entries = assign.assign_check_payees(entries[:5], 'Assets:Checking', 'f1')
+	assert [e.narration for e in new_entries] == ['Landlord /  memo / Check 101', 'CHECK  102 / memo', 'check / memo', 'SAFEWAY / memo', 'Check 103 / memo']
+	with open(str(tmp_path / 'Assets_Checking_payees_unassigned.yaml')) as f:
+		assert [line.split(':')[0] for line in f.readlines()[1:]] == ['102', '103']
+
+def test_RegexifyMany():
+	strings = ['SAFEWAY #1234', 'Checkcard  0412 AMAZON MKTPLACE', 'CHECK 1001', '12', ' ', '', 'AB', 'A1 B22 C333', 'SAFEWAY #1234']
+	expected = ['SAFEWAY .[0-9]{4}', 'AMAZON MKTPLACE', 'CHECK 1001', '^12$', 'EMPTY', '', '^AB$', 'A[0-9]{1} B[0-9]{2} C[0-9]{3}', 'SAFEWAY .[0-9]{4}']
+	assert assign.regexify_many(strings) == expected
+	assert [assign.regexify(s) for s in strings] == expected
+
+def test_Suggestions(tmp_path):
+	from beanjmw.importers.filters import suggest
+	assert suggest.tokens('SAFEWAY .[0-9]{4} STORE [0-9]') == ['SAFEWAY', 'STORE']
+	index = suggest.SuggestionIndex()
+	index.add_rules(assignLUT)
+	index.add_rules({'SAFEWAY FUEL': 'Expenses:Auto:Gas', 'KROGER': 'Expenses:UNASSIGNED'})
+	ledger = [make_entry(p, None)._replace(postings=[Posting('Liabilities:Card', None, None, None, None, {}), Posting('Expenses:Food', None, None, None, None, {})]) for p in ['SAFEWAY #1', 'SAFEWAY #2', 'TRADER JOES']]
+	index.add_history(suggest.narration_accounts(ledger))
+	assert index.suggest('SAFEWAY .[0-9]{4}')[0] == 'Expenses:Food'
+	assert index.suggest('TRADER JOES #[0-9]{3}') == ('Expenses:Food', 1.0)
+	assert index.suggest('KROGER') == (None, 0)
+	# written as a comment in the unassigned file
+	account_file = str(tmp_path / 'Liabilities_Card.yaml')
+	assign.save_unassigned({'TRADER JOES': 'Expenses:UNASSIGNED', 'NOBODY': 'Expenses:UNASSIGNED'}, account_file, 'f1', index)
+	with open(str(tmp_path / 'Liabilities_Card_unassigned.yaml')) as f:
+		lines = f.readlines()
+	assert lines[1].rstrip().endswith('Expenses:UNASSIGNED')
+	assert lines[2].rstrip().endswith('Expenses:UNASSIGNED # suggest Expenses:Food (1.00)')
+
+def test_AccountRegistry():
+	from beanjmw.importers.filters.accounts import AccountRegistry
+	from beancount.core.data import Open
+	accounts = AccountRegistry(['Liabilities:Card'])
+	e = make_entry('SAFEWAY', None)
+	assign.update_posting(e, 'Expenses:Food')
+	accounts.add(e)
+	other = AccountRegistry()
+	other.add(make_entry('SHELL', None)._replace(postings=[Posting('Expenses:Gas', None, None, None, None, {}), Posting('Expenses:Food', None, None, None, None, {})]))
+	other.add(Open({}, None, 'Expenses:Gas', None, None))
+	accounts.merge(other)
+	assert list(accounts.used) == ['Liabilities:Card', 'Expenses:Food', 'Expenses:Gas']
+	assert accounts.unopened() == ['Expenses:Food']
+
+def test_ScreenEntries():
+	from beanjmw.importers.filters.screen import screen_entries
+	from beancount.core.data import Open
+	def postings(*amounts):
+		return [Posting('A', None if a is None else Amount(D(a[0]), a[1]), None, None, None, {}) for a in amounts]
+	e = make_entry('SAFEWAY', None)
+	entries = [
+		e._replace(postings=postings(('-10.00', 'USD'))),
+		e._replace(postings=postings(('0.00', 'USD'))),
+		e._replace(postings=postings(('-10.00', 'USD'), ('10.00', 'USD'))),
+		e._replace(postings=postings(('-10.00', 'USD'), ('4', 'USD'), ('0', 'EUR'))),
+		e._replace(postings=postings(('-10.00', 'USD'), ('4', 'EUR'))),
+		e._replace(postings=postings(('-10.00', 'USD'), None)),
+		Open({}, None, 'A', None, None),
+	]
+	zero, unbalanced = screen_entries(entries)
+	assert zero == [False, True, False, False, False, False, False]
+	assert unbalanced == [True, True, False, True, False, True, False]
+	assert unbalanced[:-1] == [assign.unbalanced(x.postings) for x in entries[:-1]]
+
+def test_UnassignedStore(tmp_path):
+	import yaml
+	from beanjmw.importers.filters.unassigned import UnassignedStore
+	store = UnassignedStore()
+	check_file = str(tmp_path / 'Checking_payees_unassigned.yaml')
+	# appended by an older version: repeated header and key
+	with open(check_file, 'w') as f:
+		f.write('# Unassigned check payees for a.qfx\n101:   UNASSIGNED # 2021-03-04,-10.00 USD\n')
+		f.write('# Unassigned check payees for a.qfx\n101:   UNASSIGNED # 2021-03-04,-10.00 USD\n')
+	assert store.merge(check_file, '# Unassigned check payees for b.qfx', {101: 'UNASSIGNED # 2021-04-01,-5 USD', 99: 'Food'}) == 1
+	assert store.merge(check_file, '# Unassigned check payees for b.qfx', {99: 'Other'}) == 0
+	text = open(check_file).read()
+	assert text == '# Unassigned check payees for a.qfx\n# Unassigned check payees for b.qfx\n99:    Food\n101:   UNASSIGNED # 2021-03-04,-10.00 USD\n'
+	assert yaml.safe_load(text) == {99: 'Food', 101: 'UNASSIGNED'}
+	# payee files, and files changed on disk
+	payee_file = str(tmp_path / 'Card_unassigned.yaml')
+	store.merge(payee_file, '# Unassigned accounts for a.csv', {'SAFEWAY .[0-9]{4}': 'Expenses:UNASSIGNED # suggest Expenses:Food (1.00)'})
+	os.remove(payee_file)
+	store.merge(payee_file, '# Unassigned accounts for a.csv', {'SHELL': 'Expenses:UNASSIGNED', 'B' * 50: 'Expenses:Long'})
+	assert yaml.safe_load(open(payee_file)) == {'SHELL': 'Expenses:UNASSIGNED', 'B' * 50: 'Expenses:Long'}
+	store.merge(payee_file, '# Unassigned accounts for b.csv', {'SHELL': 'Expenses:Gas'}, replace=True)
+	assert UnassignedStore().read(payee_file)[1] == {'SHELL': 'Expenses:Gas'}
+
+def test_UpdateUnassigned():
+	unassigned_payees = {}
+	assign.update_unassigned(make_entry('SAFEWAY #1234', None), unassigned_payees)
+	assign.update_unassigned(make_entry('', 'Food:Groceries'), unassigned_payees)
+	assign.update_unassigned(make_entry('SHELL', 'Expenses:Auto'), unassigned_payees, reg_key='SHELL')
+	assert unassigned_payees == {'SAFEWAY .[0-9]{4}': 'Expenses:UNASSIGNED', 'Food.Groceries': 'Expenses:Food:Groceries', 'SHELL': 'Expenses:Auto'}
+
+def test_WorkerSettings(tmp_path, monkeypatch):
+	import multiprocessing
+	from concurrent.futures import ProcessPoolExecutor
+	account_file = str(tmp_path / 'Liabilities_Card.yaml')
+	with open(account_file, 'w') as f:
+		[f.write('"{0}": {1}\n'.format(k, v)) for k, v in assignLUT.items()]
+	zero = make_entry('SAFEWAY #1234', None)
+	zero = zero._replace(postings=[zero.postings[0]._replace(units=Amount(D('0.00'), 'USD'))])
+	monkeypatch.setattr(assign, 'remove_zero_value_transactions', False)
+	monkeypatch.setattr(assign, 'profile_rules', True)
+	settings = assign.worker_settings()
+	assert settings[assign.__name__]['profile_rules'] == True
+	# spawned workers don't inherit the settings above
+	with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+		entries, unassigned_payees, registry, profile, messages = pool.submit(assign.assign_file_worker, ([zero], account_file, settings)).result()
+	assert entries[0].postings[1].account == 'Expenses:Food'
+	assert profile['stats']['SAFEWAY #[0-9]{4}'][0] == 1
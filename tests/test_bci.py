@@ -0,0 +1,90 @@
+import io
+import os
+import shutil
+from beancount.ingest import extract
+import beanjmw.bci as bci
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+def make_downloads(tmp_path, monkeypatch):
+	downloads = tmp_path / 'downloads'
+	downloads.mkdir()
+	for fn in ['discover6789.csv', 'test1.qfx', 'vanguard.qfx']:
+		shutil.copy(os.path.join(tests_dir, fn), str(downloads))
+	monkeypatch.setattr(bci.importers.filters.assign, 'dir_path', str(tmp_path / 'yaml'))
+	os.makedirs(bci.importers.filters.assign.dir_path)
+	return str(downloads)
+
+def test_ExtractAccounts(tmp_path, monkeypatch):
+	downloads = make_downloads(tmp_path, monkeypatch)
+	jobs = [(acct, None, str(tmp_path / (acct + '_new.bc'))) for acct in ['Discover', 'BofA', 'Vanguard']]
+	# run from another directory
+	(tmp_path / 'other').mkdir()
+	monkeypatch.chdir(str(tmp_path / 'other'))
+	results = bci.extract_accounts(jobs, downloads=[downloads])
+	assert [acct for acct, _, _ in results] == ['Discover', 'BofA', 'Vanguard']
+	assert all(n > 0 for _, _, n in results)
+	# same as bci extract -a <account> in the downloads directory
+	monkeypatch.chdir(downloads)
+	for acct, _, output_file in jobs:
+		monkeypatch.setattr(bci, 'account_filter', acct)
+		output = io.StringIO()
+		output.write('option "booking_method" "FIFO"\n')
+		extract.extract(bci.CONFIG, [downloads], output, hooks=[bci.process_extracted_entries])
+		with open(output_file) as f:
+			assert f.read() == output.getvalue(), acct
+
+def test_RemoveOption():
+	for argv in [['bci', 'extract', '-j', '0', '-a', 'X'], ['bci', 'extract', '-j0', '-a', 'X'], ['bci', 'extract', '--jobs=2', '-a', 'X'], ['bci', 'extract', '-a', 'X']]:
+		bci.remove_option(argv, ['-j', '--jobs'])
+		assert argv == ['bci', 'extract', '-a', 'X']
+	argv = ['bci', 'extract', '--existing', 'ledger.bc']
+	bci.remove_option(argv, ['-e', '-f', '--existing', '--previous'])
+	assert argv == ['bci', 'extract']
+
+def test_IdentifyDownloads(tmp_path, monkeypatch):
+	downloads = make_downloads(tmp_path, monkeypatch)
+	identified = bci.identify_downloads([downloads])
+	assert [(os.path.basename(fn), acct) for fn, _, acct in identified] == [
+		('discover6789.csv', 'Liabilities:US:Discover:D6789'),
+		('test1.qfx', 'Assets:US:BofA:Checking'),
+		('vanguard.qfx', 'Assets:US:Vanguard:V9999')]
+	assert [name for _, name, _ in identified] == ['importers.csv.csv_general.Importer', 'importers.ofx.ofx_general.Importer', 'importers.ofx.ofx_general.Importer']
+
+def test_ArchiveDownloads(tmp_path, monkeypatch):
+	downloads = make_downloads(tmp_path, monkeypatch)
+	files = str(tmp_path / 'files')
+	# file dates come from the mtime
+	for fn in os.listdir(downloads):
+		os.utime(os.path.join(downloads, fn), (1614888000, 1614888000))
+	jobs = bci.archive_downloads(files, dry_run=True, downloads=[downloads])
+	assert [(os.path.basename(src), os.path.relpath(dst, files)) for src, dst in jobs] == [
+		('discover6789.csv', os.path.join('Liabilities', 'US', 'Discover', 'D6789', '2021-03-04.discover6789.csv')),
+		('test1.qfx', os.path.join('Assets', 'US', 'BofA', 'Checking', '2021-03-04.test1.qfx')),
+		('vanguard.qfx', os.path.join('Assets', 'US', 'Vanguard', 'V9999', '2021-03-04.vanguard.qfx'))]
+	assert not os.path.exists(files)
+	# a dry run with existing destinations fails like the move
+	existing = jobs[0][1]
+	os.makedirs(os.path.dirname(existing))
+	open(existing, 'w').close()
+	assert bci.archive_downloads(files, dry_run=True, downloads=[downloads], overwrite=False) == []
+	assert bci.archive_downloads(files, downloads=[downloads], overwrite=False) == []
+	assert len(os.listdir(downloads)) == 3
+	# two downloads with the same destination
+	os.makedirs(os.path.join(downloads, 'sub'))
+	shutil.copy2(jobs[0][0], os.path.join(downloads, 'sub'))
+	assert bci.archive_downloads(files, dry_run=True, downloads=[downloads]) == []
+	assert bci.archive_downloads(files, downloads=[downloads]) == []
+	assert os.path.getsize(existing) == 0
+	shutil.rmtree(os.path.join(downloads, 'sub'))
+	assert bci.archive_downloads(files, downloads=[downloads]) == jobs
+	assert os.listdir(downloads) == []
+	assert all(os.path.isfile(dst) for _, dst in jobs)
+
+def test_MoveDownloads():
+	for argv in [['bci', 'extract', '-d', 'a', '--downloads=b'], ['bci', '-d', 'a', 'extract', '-d', 'b'], ['bci', '-d', 'a', '-db', 'extract']]:
+		bci.move_downloads(argv, ['/x/a', '/x/b'])
+		assert argv == ['bci', '-d', '/x/a', '-d', '/x/b', 'extract']
+	argv = ['bci', 'extract', '-d', 'a', '-e', 'ledger.bc']
+	bci.move_downloads(argv, ['/x/a'])
+	assert argv == ['bci', '-d', '/x/a', 'extract', '-e', 'ledger.bc']
@@ -0,0 +1,180 @@
+from beanjmw.importers.filters import assign, dedup
+from beanjmw.importers.filters.dedup import DedupIndex
+from beancount.core.data import Transaction, Posting, Amount, D, Open, Balance, Price
+import datetime
+import os
+
+day = datetime.date(2021, 3, 4)
+next_day = datetime.date(2021, 3, 5)
+
+def txn(date, postings, narration='n'):
+	return Transaction({}, date, '*', None, narration, frozenset(), frozenset(),
+		[Posting(a, Amount(D(n), c), None, None, None, {}) for a, n, c in postings])
+
+ledger = [
+	txn(day, [('Assets:Checking', '-10.00', 'USD'), ('Expenses:Food', '10.00', 'USD')]),
+	txn(day, [('Expenses:Food', '10.00', 'USD'), ('Assets:Checking', '-10.001', 'USD')]),
+	txn(next_day, [('Assets:Checking', '-10.00', 'USD')]),
+	txn(day, [('Assets:Checking', '-10.00', 'EUR')]),
+	Open({}, day, 'Assets:Checking', None, None),
+	Balance({}, day, 'Assets:Checking', Amount(D('5'), 'USD'), None, None),
+	Price({}, day, 'VTI', Amount(D('200'), 'USD')),
+]
+
+def test_CompareEntries():
+	extracted = [
+		txn(day, [('Assets:Checking', '-10.00', 'USD')]),
+		txn(day, [('Assets:Checking', '-10.02', 'USD')]),
+		txn(next_day, [('Expenses:Food', '10.00', 'USD')]),
+		Open({}, day, 'Assets:Checking', None, None),
+		Open({}, next_day, 'Assets:Checking', None, None),
+		Balance({}, day, 'Assets:Checking', Amount(D('7'), 'USD'), None, None),
+		Price({}, day, 'VTI', Amount(D('201'), 'USD')),
+	]
+	dups = assign.compare_entries(extracted, ledger)
+	# same date, first posting account, currency and amount within a cent
+	assert dups[0] == ledger[0:2]
+	assert dups[1] == []
+	assert dups[2] == []
+	assert dups[3] == [ledger[4]]
+	assert dups[4] == []
+	assert dups[5] == [ledger[5]]
+	assert dups[6] == [ledger[6]]
+
+def test_DedupIndex():
+	index = DedupIndex(ledger)
+	assert index.duplicates(ledger[2]) == [ledger[2]]
+	assert index.duplicates(txn(day, [])) == []
+	index.add(ledger[2])
+	assert index.duplicates(ledger[2]) == [ledger[2], ledger[2]]
+
+ledger_text = """
+2021-01-01 open Assets:Checking USD
+2021-01-01 open Expenses:Food USD
+
+2021-03-04 * "Safeway"
+  Assets:Checking  -10.00 USD
+  Expenses:Food     10.00 USD
+"""
+
+new_text = """
+2021-03-05 * "Safeway"
+  Assets:Checking  -12.00 USD
+  Expenses:Food     12.00 USD
+"""
+
+def test_LedgerIndex(tmp_path):
+	ledger_file = str(tmp_path / 'Checking.bc')
+	with open(ledger_file, 'w') as f:
+		f.write(ledger_text)
+	index = dedup.get_ledger_index(ledger_file)
+	assert os.path.isfile(dedup.ledger_index_file(ledger_file))
+	assert sorted(index.open_accounts()) == ['Assets:Checking', 'Expenses:Food']
+	assert [len(d) for d in assign.compare_entries(ledger, index)] == [1, 1, 0, 0, 0, 0, 0]
+	# saved index is used while the ledger is unchanged
+	saved = dedup.load_ledger_index(ledger_file)
+	assert saved.buckets == index.buckets
+	# stage --update: ledger becomes ledger + new entries
+	new_file = str(tmp_path / 'Checking_new.bc')
+	with open(new_file, 'w') as f:
+		f.write(new_text)
+	with open(ledger_file, 'a') as f:
+		f.write(new_text)
+	assert dedup.load_ledger_index(ledger_file) == None
+	updated = dedup.update_ledger_index(ledger_file, new_file)
+	assert len(updated.duplicates(txn(next_day, [('Assets:Checking', '-12.00', 'USD')]))) == 1
+	assert dedup.load_ledger_index(ledger_file).buckets == dedup.build_ledger_index(ledger_file).buckets
+
+def test_BloomFilter():
+	index = DedupIndex(ledger)
+	index.new_bloom()
+	# every indexed entry passes, including amounts within compare_delta
+	for e in ledger:
+		assert len(index.duplicates(e)) > 0
+	assert len(index.duplicates(txn(day, [('Expenses:Food', '9.995', 'USD')]))) == 2
+	assert index.misses == 0
+	for i in range(200):
+		assert index.duplicates(txn(day, [('Assets:Checking', str(100 + i), 'USD')])) == []
+	assert index.misses + index.false_positives == 200
+	assert index.misses > 150
+	assert 'miss' in index.bloom_stats()
+
+def test_PostingIndex(monkeypatch):
+	cash_x = txn(day, [('Assets:Cash', '-10.00', 'USD'), ('Expenses:X', '10.00', 'USD')])
+	cash_y = txn(day, [('Assets:Cash', '-10.00', 'USD'), ('Expenses:Y', '10.00', 'USD')])
+	index = dedup.PostingIndex([cash_x, ledger[4], cash_y])
+	assert index.duplicates(cash_x) == [cash_x]
+	assert index.duplicates(cash_y) == [cash_y]
+	# first posting only finds both
+	assert DedupIndex([cash_x, cash_y]).duplicates(cash_x) == [cash_x, cash_y]
+	# postings without units only match on account
+	extracted = cash_x._replace(postings=[cash_x.postings[0], cash_x.postings[1]._replace(units=None)])
+	assert index.duplicates(extracted) == [cash_x]
+	assert index.duplicates(extracted._replace(date=next_day)) == []
+	assert index.duplicates(ledger[4]) == [ledger[4]]
+	monkeypatch.setattr(assign, 'multi_posting_dedup', True)
+	assert assign.compare_entries([cash_x, cash_y], [cash_y]) == [[], [cash_y]]
+
+def test_Deduplicate(monkeypatch):
+	a = txn(day, [('Assets:Checking', '-10.00', 'USD')])
+	b = txn(day, [('Assets:Checking', '-20.00', 'USD')])
+	c = txn(next_day, [('Assets:Checking', '-30.00', 'USD')])
+	extracted = [('f1', [a, b]), ('f2', [b, c]), ('f3', [c])]
+	monkeypatch.setattr(assign, 'remove_duplicates', False)
+	# no ledger: the last list is passed through unchanged
+	res = assign.deduplicate(extracted, None)
+	assert [fn for fn, _ in res] == ['f1', 'f2', 'f3']
+	assert [e.meta.get('mark') for e in res[0][1]] == [None, 'Duplicate']
+	assert [e.meta.get('mark') for e in res[1][1]] == [None, 'Duplicate']
+	assert res[2][1] == [c]
+	# ledger list or its index give the same result
+	res = assign.deduplicate(extracted, [a])
+	assert [e.meta.get('mark') for e in res[0][1]] == ['Duplicate', 'Duplicate']
+	assert [e.meta.get('mark') for e in res[2][1]] == [None]
+	assert assign.deduplicate(extracted, DedupIndex([a])) == res
+	monkeypatch.setattr(assign, 'remove_duplicates', True)
+	res = assign.deduplicate(extracted, [a])
+	assert res == [('f1', []), ('f2', [b]), ('f3', [c])]
+
+def test_DeduplicateIter():
+	a = txn(day, [('Assets:Checking', '-10.00', 'USD')])
+	b = txn(day, [('Assets:Checking', '-20.00', 'USD')])
+	extracted = [('f1', [a, b]), ('f2', [b]), ('f3', [a])]
+	# generator in, one pair at a time out, same as the list version
+	res = assign.deduplicate_iter((x for x in extracted), [a])
+	assert not isinstance(res, list)
+	assert list(res) == assign.deduplicate(extracted, [a])
+	assert list(assign.auto_open_iter([('f1', [a, ledger[4]])])) == [('f1', [a])]
+	# nothing to compare one file with
+	assert list(assign.deduplicate_iter(iter([('f1', [a, a])]), None)) == [('f1', [a, a])]
+	assert assign.deduplicate([('f1', [a])], []) == [('f1', [a])]
+	assert assign.new_opens_first(iter([('f1', [a]), ('new_opens', [])])) == [('new_opens', []), ('f1', [a])]
+
+def test_SamePostings():
+	split = txn(day, [('Assets:Checking', '-12.00', 'USD'), ('Expenses:Food', '5.00', 'USD'), ('Expenses:Food', '7.00', 'USD')])
+	extracted = split._replace(postings=[split.postings[0], split.postings[1]._replace(units=None), split.postings[1]])
+	fp_a, fp_b = dedup.posting_fingerprint(extracted), dedup.posting_fingerprint(split)
+	# the posting without units sorts first, it must not take the 5.00 posting
+	assert fp_a[1] == ('Expenses:Food', None, None)
+	assert dedup.same_postings(fp_a, fp_b)
+	assert dedup.PostingIndex([split]).duplicates(extracted) == [split]
+	other = extracted._replace(postings=extracted.postings[:2] + [split.postings[1]._replace(units=Amount(D('6.00'), 'USD'))])
+	assert not dedup.same_postings(dedup.posting_fingerprint(other), fp_b)
+	assert not dedup.same_postings(fp_b + fp_b[:1], fp_b)
+
+def test_UpdateLedgerIndexEdited(tmp_path):
+	ledger_file = str(tmp_path / 'Checking.bc')
+	with open(ledger_file, 'w') as f:
+		f.write(ledger_text)
+	dedup.get_ledger_index(ledger_file)
+	new_file = str(tmp_path / 'Checking_new.bc')
+	with open(new_file, 'w') as f:
+		f.write(new_text)
+	# hand edit of the same size, then stage --update
+	with open(ledger_file, 'w') as f:
+		f.write(ledger_text.replace('10.00', '11.00') + new_text)
+	updated = dedup.update_ledger_index(ledger_file, new_file)
+	assert updated.duplicates(txn(day, [('Assets:Checking', '-10.00', 'USD')])) == []
+	assert len(updated.duplicates(txn(day, [('Assets:Checking', '-11.00', 'USD')]))) == 1
+	assert len(updated.duplicates(txn(next_day, [('Assets:Checking', '-12.00', 'USD')]))) == 1
+	assert dedup.load_ledger_index(ledger_file).buckets == dedup.build_ledger_index(ledger_file).buckets
@@ -0,0 +1,127 @@
+from beanjmw.importers import ingest_cache
+from beanjmw.importers.ingest_cache import CachedImporter, cached_config
+from beancount.ingest import cache
+from beancount.core.data import Open
+import datetime
+import sys
+
+class CountingImporter:
+	# not attributes of the instance, which would change its settings
+	extracts = 0
+	identifies = 0
+
+	def __init__(self, account_name):
+		self.account_name = account_name
+
+	def name(self):
+		return 'CountingImporter'
+
+	def identify(self, file):
+		CountingImporter.identifies += 1
+		return file.name.endswith('.csv')
+
+	def extract(self, file, existing_entries=None):
+		CountingImporter.extracts += 1
+		self.currencies = ['USD']
+		sys.stderr.write("Skipping line\n")
+		return [Open({'filename': file.name}, datetime.date(2021, 3, 4), self.account_name, None, None)]
+
+def test_ExtractCache(tmp_path, capsys, monkeypatch):
+	download = tmp_path / 'download.csv'
+	download.write_text('a,b\n')
+	cache_dir = str(tmp_path / 'cache')
+	CountingImporter.extracts = 0
+	importer = CountingImporter('Assets:Checking')
+	cached = cached_config([importer], cache_dir)[0]
+	assert cached.name() == 'CountingImporter'
+	assert cached_config([cached]) == [cached]
+	first = cached.extract(cache.get_file(str(download)))
+	# next run
+	importer = CountingImporter('Assets:Checking')
+	cached = CachedImporter(importer, cache_dir)
+	again = cached.extract(cache.get_file(str(download)))
+	assert CountingImporter.extracts == 1 and cached.hits == 1
+	assert again == first and again is not first
+	# attributes set by extract are restored from the cache
+	assert importer.currencies == ['USD']
+	# importer messages are repeated from the cache
+	assert capsys.readouterr().err == "Skipping line\n" * 2
+	# other settings or contents are extracted again
+	importer.account_name = 'Assets:Savings'
+	assert cached.extract(cache.get_file(str(download)))[0].account == 'Assets:Savings'
+	download.write_text('a,b,c\n')
+	cached.extract(cache.get_file(str(download)))
+	assert CountingImporter.extracts == 3
+	monkeypatch.setattr(ingest_cache, 'use_extract_cache', False)
+	cached.extract(cache.get_file(str(download)))
+	assert CountingImporter.extracts == 4
+
+def test_IdentifyCache(tmp_path):
+	download = tmp_path / 'download.csv'
+	download.write_text('a,b\n')
+	other = tmp_path / 'other.qfx'
+	other.write_text('<OFX>\n')
+	cache_dir = str(tmp_path / 'cache')
+	cached = CachedImporter(CountingImporter('Assets:Checking'), cache_dir)
+	CountingImporter.identifies = 0
+	assert cached.identify(cache.get_file(str(download)))
+	assert not cached.identify(cache.get_file(str(other)))
+	assert cached.identify(cache.get_file(str(download)))
+	assert CountingImporter.identifies == 2
+	index = ingest_cache.get_identify_index(cache_dir)
+	index.save()
+	# a new process reads the saved results
+	saved = ingest_cache.IdentifyIndex(index.filename)
+	key = ingest_cache.importer_key(cached.importer)
+	assert saved.get(str(download), key) == True
+	assert saved.get(str(other), key) == False
+	# new contents, or removed files, aren't kept
+	download.write_text('x\n')
+	other.unlink()
+	assert saved.get(str(download), key) == None
+	saved.put(str(download), key, False)
+	saved.save()
+	assert ingest_cache.IdentifyIndex(index.filename).read()[1] == {str(download): {(saved.digest(str(download)), key): False}}
+
+def test_Prefetch(tmp_path, capsys):
+	download = tmp_path / 'download.csv'
+	download.write_text('a,b\n')
+	cached = CachedImporter(CountingImporter('Assets:Checking'), str(tmp_path / 'cache'))
+	CountingImporter.extracts = 0
+	# extracted in another process
+	entries = [Open({}, datetime.date(2021, 3, 4), 'Assets:Other', None, None)]
+	cached.prefetch(str(download), entries, "Skipping other\n")
+	assert cached.extract(cache.get_file(str(download))) is entries
+	assert CountingImporter.extracts == 0
+	assert capsys.readouterr().err == "Skipping other\n"
+	# only once
+	assert cached.extract(cache.get_file(str(download)))[0].account == 'Assets:Checking'
+
+def test_PruneCache(tmp_path):
+	import os, time
+	cache_dir = str(tmp_path / 'cache')
+	download = tmp_path / 'download.csv'
+	download.write_text('a,b\n')
+	cached = CachedImporter(CountingImporter('Assets:Checking'), cache_dir)
+	# extract sets an attribute, which is part of the key
+	cached.extract(cache.get_file(str(download)))
+	cached.extract(cache.get_file(str(download)))
+	cache_file = cached.cache_file(str(download))
+	assert os.path.isfile(cache_file)
+	# the cache's own files are never downloads
+	assert not cached.identify(cache.get_file(cache_file))
+	assert ingest_cache.in_cache_dir(cache_file, cache_dir) and not ingest_cache.in_cache_dir(str(download), cache_dir)
+	old = time.time() - 100 * 86400
+	os.utime(cache_file, (old, old))
+	with open(os.path.join(cache_dir, 'x.pickle.1.tmp'), 'w') as f:
+		f.write('')
+	assert ingest_cache.prune_cache(cache_dir, max_age=200) == 0
+	os.utime(os.path.join(cache_dir, 'x.pickle.1.tmp'), (old, old))
+	# reading an entry keeps it
+	cached.extract(cache.get_file(str(download)))
+	assert ingest_cache.prune_cache(cache_dir, max_age=1) == 1
+	assert os.path.isfile(cache_file)
+	os.utime(cache_file, (old, old))
+	assert ingest_cache.prune_cache(cache_dir, max_age=1) == 1
+	assert not os.path.isfile(cache_file)
+	assert ingest_cache.prune_cache(str(tmp_path / 'none')) == 0
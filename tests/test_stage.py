@@ -0,0 +1,34 @@
+from beanjmw import stage
+
+main_ledger = """
+include "other.bc"
+2021-01-01 open Assets:Checking USD
+
+2021-03-04 * "Safeway"
+  Assets:Checking  -10.00 USD
+  Expenses:Food     10.00 USD
+"""
+
+other_ledger = """
+2021-03-05 * "Shell"
+  Assets:Checking  -20.00 USD
+  Expenses:Auto     20.00 USD
+
+2021-03-06 * "Acme"
+  Assets:Checking  -30.00 USD
+  Expenses:Auto     30.00 USD
+"""
+
+def test_Check(tmp_path, capsys):
+	rc_path = str(tmp_path / 'Checking_rc.bc')
+	with open(rc_path, 'w') as f:
+		f.write(main_ledger)
+	with open(str(tmp_path / 'other.bc'), 'w') as f:
+		f.write(other_ledger)
+	# only errors in the release candidate itself are counted
+	assert not stage.check('Assets:Checking', rc_path)
+	assert 'Errors for Assets:Checking, {0}: 1'.format(rc_path) in capsys.readouterr().out
+	with open(str(tmp_path / 'other.bc'), 'w') as f:
+		f.write('2021-01-01 open Expenses:Food\n')
+	assert stage.check('Assets:Checking', rc_path)
+	assert 'Check passed' in capsys.readouterr().out
@@ -0,0 +1,36 @@
+import io
+from beanjmw import yaml_util
+
+existing_yaml = """'SAFEWAY': Expenses:Food
+'SAFEWAY.*STORE': Expenses:Food
+'ACME': UNASSIGNED # 2021-03-04 -10.00
+"""
+
+def run_main(argv):
+	output = io.StringIO()
+	yaml_util.main(argv, output)
+	return output.getvalue().splitlines()
+
+def test_Main(tmp_path):
+	existing = str(tmp_path / 'existing.yaml')
+	with open(existing, 'w') as f:
+		f.write(existing_yaml)
+	add = str(tmp_path / 'add.yaml')
+	with open(add, 'w') as f:
+		f.write("'SHELL': Expenses:Auto\n")
+	# sorted, second column at 40 for regex keys, unassigned comments kept
+	assert run_main(['-e', existing]) == [
+		"'ACME':" + ' ' * 36 + 'UNASSIGNED #  2021-03-04 -10.00',
+		"'SAFEWAY':" + ' ' * 33 + 'Expenses:Food',
+		"'SAFEWAY.*STORE':" + ' ' * 26 + 'Expenses:Food']
+	assert run_main(['-e', existing, '-a', add, '-cw', '12']) == [
+		"'ACME':        UNASSIGNED #  2021-03-04 -10.00",
+		"'SAFEWAY':     Expenses:Food",
+		"'SAFEWAY.*STORE': Expenses:Food",
+		"'SHELL':       Expenses:Auto"]
+	assert run_main(['-e', existing, '-sp', '-cw', '10']) == [
+		'# yaml_util: Removed 1 of 3 redundant regex patterns',
+		"'ACME':      UNASSIGNED #  2021-03-04 -10.00",
+		"'SAFEWAY':   Expenses:Food"]
+	assert run_main(['-e', existing, '-iv']) == [
+		'Expenses:Food:', " - 'SAFEWAY'", " - 'SAFEWAY.*STORE'", 'UNASSIGNED:', " - 'ACME'"]